@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+from setuptools import setup
+
+setup(
+    name="verilogoj-toolchain",
+    version="0.1",
+    description="VerilogOJServices中各服务调用外部工具的公共代码",
+    py_modules=["toolchain"],
+    install_requires=["fastapi", "pydantic", "prometheus_client"],
+)
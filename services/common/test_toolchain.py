@@ -0,0 +1,239 @@
+import asyncio
+import json
+import os
+import signal
+import time
+
+import pytest
+from fastapi import Body, FastAPI
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+
+import toolchain
+from toolchain import (
+    OUTPUT_LIMIT_EXCEEDED,
+    TIME_LIMIT_EXCEEDED,
+    ProcessLog,
+    ResourceLimits,
+    ToolchainBusyError,
+    WorkspaceManager,
+    admit_request,
+    install_service_routes,
+    run_tool,
+)
+
+
+def limits(**kwargs) -> ResourceLimits:
+    return ResourceLimits(
+        **{
+            "cpu_seconds": 0,
+            "wall_seconds": 10,
+            "memory_bytes": 0,
+            "output_bytes": 0,
+            **kwargs,
+        }
+    )
+
+
+def alive(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # 已结束但未被回收的进程为Z
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_run_tool():
+    completed = asyncio.run(run_tool(["sh", "-c", "echo out; echo err >&2; exit 3"]))
+    assert completed.returncode == 3
+    assert completed.stdout == b"out\n"
+    assert completed.stderr == b"err\n"
+    assert completed.verdict == ""
+    assert completed.rusage is not None
+
+
+def test_cpu_time_limit():
+    completed = asyncio.run(
+        run_tool(["sh", "-c", "while :; do :; done"], limits=limits(cpu_seconds=1))
+    )
+    assert completed.returncode == -signal.SIGXCPU
+    assert completed.verdict == TIME_LIMIT_EXCEEDED
+    assert "运行超时" in completed.stderr.decode("utf-8")
+
+
+def test_wall_time_limit():
+    time_start = time.monotonic()
+    completed = asyncio.run(run_tool(["sleep", "30"], limits=limits(wall_seconds=0.5)))
+    assert time.monotonic() - time_start < 5
+    assert completed.returncode == -signal.SIGKILL
+    assert completed.verdict == TIME_LIMIT_EXCEEDED
+
+
+def test_output_limit(tmp_path):
+    completed = asyncio.run(
+        run_tool(
+            ["sh", "-c", "exec seq 1000000 > out.txt"],
+            cwd=str(tmp_path),
+            limits=limits(output_bytes=1000),
+        )
+    )
+    assert completed.returncode == -signal.SIGXFSZ
+    assert completed.verdict == OUTPUT_LIMIT_EXCEEDED
+    assert os.path.getsize(tmp_path / "out.txt") <= 1000
+
+
+def test_stdout_is_bounded(monkeypatch):
+    monkeypatch.setattr(toolchain, "TOOL_OUTPUT_BUFFER_BYTES", 1000)
+    completed = asyncio.run(run_tool(["seq", "100000"]))
+    assert completed.returncode == 0
+    assert completed.stdout.startswith(b"1\n2\n3\n")
+    assert len(completed.stdout) < 1100
+    assert "字节输出未保留" in completed.stdout.decode("utf-8")
+
+
+def test_cancel_kills_process_group(tmp_path):
+    pid_path = tmp_path / "pid"
+
+    async def main():
+        task = asyncio.ensure_future(
+            run_tool(
+                ["sh", "-c", f"sleep 30 & echo $! > {pid_path}; wait"],
+                limits=limits(wall_seconds=60),
+            )
+        )
+        while not pid_path.exists() or pid_path.read_text() == "":
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    pid = int(pid_path.read_text())
+    # 工具创建的子进程也被结束
+    for _ in range(100):
+        if not alive(pid):
+            break
+        time.sleep(0.01)
+    assert not alive(pid)
+
+
+def test_busy_rejection(monkeypatch):
+    monkeypatch.setattr(toolchain, "MAX_QUEUED_TOOLS", 0)
+
+    with pytest.raises(ToolchainBusyError):
+        asyncio.run(run_tool(["true"]))
+
+    async def admit():
+        admit_request("true")
+
+    with pytest.raises(ToolchainBusyError) as e:
+        asyncio.run(admit())
+    assert e.value.retry_after >= 1
+
+
+def test_admitted_request_waits(monkeypatch):
+    async def main():
+        admit_request("true")
+        # 通过之后排队的进程再多也只排队 包括gather创建的task
+        monkeypatch.setattr(toolchain, "MAX_QUEUED_TOOLS", 0)
+        return await asyncio.gather(run_tool(["true"]), run_tool(["true"]))
+
+    assert [completed.returncode for completed in asyncio.run(main())] == [0, 0]
+
+
+def test_process_log():
+    log = ProcessLog(max_chars=10)
+    for i in range(10):
+        log.write(str(i) * 3)
+    # 保留开头和结尾各5个字符
+    assert str(log) == "00011\n……（省略20个字符）……\n88999"
+
+    log = ProcessLog(max_chars=10)
+    log.write("abc")
+    assert str(log) == "abc"
+
+    log = ProcessLog(max_chars=0)
+    log.write("a" * 1000)
+    assert str(log) == "a" * 1000
+
+
+def test_process_log_max_chars_1():
+    log = ProcessLog(max_chars=1)
+    for _ in range(3):
+        log.write("abc")
+    assert str(log) == "a\n……（省略8个字符）……\n"
+
+
+def make_folder(root, name: str, size: int, age_seconds: float) -> str:
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "data"), "wb") as f:
+        f.write(b"0" * size)
+    mtime = time.time() - age_seconds
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_sweep_by_age(tmp_path):
+    manager = WorkspaceManager(
+        root=str(tmp_path),
+        keep_on_failure=True,
+        max_age_seconds=60,
+        max_bytes=0,
+        sweep_interval_seconds=0,
+    )
+    old = make_folder(tmp_path, "old", 10, age_seconds=120)
+    new = make_folder(tmp_path, "new", 10, age_seconds=0)
+    active = manager.create()
+    manager.sweep()
+    assert not os.path.exists(old)
+    assert os.path.exists(new)
+    assert os.path.exists(active)
+
+
+def test_sweep_by_size(tmp_path):
+    manager = WorkspaceManager(
+        root=str(tmp_path),
+        keep_on_failure=True,
+        max_age_seconds=0,
+        max_bytes=250,
+        sweep_interval_seconds=0,
+    )
+    oldest = make_folder(tmp_path, "oldest", 100, age_seconds=30)
+    older = make_folder(tmp_path, "older", 100, age_seconds=20)
+    newest = make_folder(tmp_path, "newest", 100, age_seconds=10)
+    manager.sweep()
+    # 从最旧的开始删除 直到总大小不超过max_bytes
+    assert not os.path.exists(oldest)
+    assert os.path.exists(older)
+    assert os.path.exists(newest)
+
+
+def test_service_routes(tmp_path, monkeypatch):
+    monkeypatch.setattr(toolchain.workspaces, "root", str(tmp_path))
+
+    class ServiceError(BaseModel):
+        error: str = Body(title="错误信息")
+        log: str = Body(title="过程日志")
+
+    app = FastAPI()
+    install_service_routes(app, ["sh", "no-such-tool"], ServiceError)
+
+    @app.get("/busy")
+    async def busy():
+        raise ToolchainBusyError("sh", 10, 3)
+
+    with TestClient(app) as client:
+        assert client.get("/healthz").json() == {"status": "ok"}
+        response = client.get("/readyz")
+        assert response.status_code == 503
+        assert response.json()["missing"] == ["no-such-tool"]
+        assert client.get("/metrics").status_code == 200
+
+        response = client.get("/busy")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "3"
+        error = json.loads(response.json()["detail"])
+        assert "服务繁忙" in error["error"]
+        assert error["log"] == ""
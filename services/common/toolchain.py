@@ -0,0 +1,1178 @@
+"""
+调用yosys/iverilog/vvp/sta/netlistsvg等外部工具的公共代码
+
+各服务通过`pip3 install -e ../common`安装本模块后以`from toolchain import ...`导入
+"""
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import math
+import os
+import resource
+import selectors
+import shutil
+import signal
+import subprocess
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Type, Union
+
+from fastapi import Body, FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import JSONResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    ProcessCollector,
+    generate_latest,
+)
+from pydantic import BaseModel
+
+# 同时运行的外部工具进程数上限
+MAX_CONCURRENT_TOOLS = int(os.environ.get("MAX_CONCURRENT_TOOLS", os.cpu_count() or 1))
+# 等待运行的外部工具进程数上限 超出时直接拒绝（ToolchainBusyError）而不是继续排队
+MAX_QUEUED_TOOLS = int(os.environ.get("MAX_QUEUED_TOOLS", 4 * MAX_CONCURRENT_TOOLS))
+# 外部工具的stdout和stderr各保留的字节数 超出部分丢弃 避免大量输出占满内存
+TOOL_OUTPUT_BUFFER_BYTES = int(os.environ.get("TOOL_OUTPUT_BUFFER_BYTES", 1024 * 1024))
+
+
+def max_concurrent(tool: str) -> int:
+    """单个工具同时运行的进程数上限 如`MAX_CONCURRENT_YOSYS` 默认与MAX_CONCURRENT_TOOLS相同"""
+    return int(os.environ.get(f"MAX_CONCURRENT_{tool.upper()}", MAX_CONCURRENT_TOOLS))
+
+
+class ResourceLimits(NamedTuple):
+    """
+    外部工具进程的资源上限 为0表示不限制
+    cpu_seconds: CPU时间（RLIMIT_CPU）
+    wall_seconds: 墙钟时间 超出后结束整个进程组
+    memory_bytes: 虚拟内存（RLIMIT_AS）
+    output_bytes: 单个输出文件的大小（RLIMIT_FSIZE） 如vvp输出的波形文件
+    """
+
+    cpu_seconds: int
+    wall_seconds: float
+    memory_bytes: int
+    output_bytes: int
+
+
+# 各工具资源上限的默认值 未列出的工具使用"*"
+# vvp运行的是用户提交的代码 一个没有延时的`always`就能让它永远运行下去 因此限制得更严
+_DEFAULT_RESOURCE_LIMITS = {
+    "*": ResourceLimits(
+        cpu_seconds=60,
+        wall_seconds=120,
+        memory_bytes=2 * 1024 * 1024 * 1024,
+        output_bytes=512 * 1024 * 1024,
+    ),
+    "vvp": ResourceLimits(
+        cpu_seconds=10,
+        wall_seconds=30,
+        memory_bytes=1024 * 1024 * 1024,
+        output_bytes=256 * 1024 * 1024,
+    ),
+}
+
+
+def resource_limits(tool: str) -> ResourceLimits:
+    """
+    单个工具的资源上限 如`VVP_CPU_SECONDS` `YOSYS_MEMORY_BYTES`
+    没有单独配置时使用`TOOL_CPU_SECONDS`等 再没有则使用默认值
+    """
+    default = _DEFAULT_RESOURCE_LIMITS.get(tool, _DEFAULT_RESOURCE_LIMITS["*"])
+
+    def limit(name: str, convert):
+        value = os.environ.get(f"{tool.upper()}_{name}", os.environ.get(f"TOOL_{name}"))
+        return getattr(default, name.lower()) if value is None else convert(value)
+
+    return ResourceLimits(
+        cpu_seconds=limit("CPU_SECONDS", int),
+        wall_seconds=limit("WALL_SECONDS", float),
+        memory_bytes=limit("MEMORY_BYTES", int),
+        output_bytes=limit("OUTPUT_BYTES", int),
+    )
+
+
+# ToolResult.verdict 进程因超出资源上限而被结束
+TIME_LIMIT_EXCEEDED = "time_limit_exceeded"
+OUTPUT_LIMIT_EXCEEDED = "output_limit_exceeded"
+
+
+# [监控指标]
+# 在`GET /metrics`以Prometheus的格式输出
+# 使用单独的registry 只输出本模块定义的指标
+
+metrics_registry = CollectorRegistry()
+ProcessCollector(registry=metrics_registry)
+
+# 外部工具从几毫秒到几分钟不等
+_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+requests_total = Counter(
+    "verilogoj_requests",
+    "处理完的HTTP请求数",
+    ["endpoint", "method", "status"],
+    registry=metrics_registry,
+)
+request_duration_seconds = Histogram(
+    "verilogoj_request_duration_seconds",
+    "HTTP请求的处理时间 流式响应计到最后一块数据发送完",
+    ["endpoint", "method"],
+    buckets=_SECONDS_BUCKETS,
+    registry=metrics_registry,
+)
+stage_duration_seconds = Histogram(
+    "verilogoj_stage_duration_seconds",
+    "请求中各阶段的耗时 见StageTimer",
+    ["endpoint", "stage"],
+    buckets=_SECONDS_BUCKETS,
+    registry=metrics_registry,
+)
+tool_processes = Gauge(
+    "verilogoj_tool_processes",
+    "正在运行的外部工具进程数",
+    ["tool"],
+    registry=metrics_registry,
+)
+tool_queued = Gauge(
+    "verilogoj_tool_queued",
+    "排队等待运行的外部工具进程数",
+    ["tool"],
+    registry=metrics_registry,
+)
+tool_queue_wait_seconds = Histogram(
+    "verilogoj_tool_queue_wait_seconds",
+    "外部工具排队等待的时间",
+    ["tool"],
+    buckets=_SECONDS_BUCKETS,
+    registry=metrics_registry,
+)
+tool_rejected_total = Counter(
+    "verilogoj_tool_rejected",
+    "因排队的进程过多而拒绝运行外部工具的次数（ToolchainBusyError）",
+    ["tool"],
+    registry=metrics_registry,
+)
+tool_cpu_seconds_total = Counter(
+    "verilogoj_tool_cpu_seconds",
+    "外部工具进程的CPU时间 mode为user或system",
+    ["tool", "mode"],
+    registry=metrics_registry,
+)
+cache_lookups_total = Counter(
+    "verilogoj_cache_lookups",
+    "缓存的查找次数 result为hit或miss 两者之比即命中率",
+    ["cache", "result"],
+    registry=metrics_registry,
+)
+cache_bytes = Gauge(
+    "verilogoj_cache_bytes",
+    "缓存占用的磁盘空间 在写入缓存时更新",
+    ["cache"],
+    registry=metrics_registry,
+)
+workspace_bytes = Gauge(
+    "verilogoj_workspace_bytes",
+    "工作目录占用的磁盘空间 在定期清理时更新",
+    registry=metrics_registry,
+)
+workspaces_active = Gauge(
+    "verilogoj_workspaces_active",
+    "正在使用的工作目录数",
+    registry=metrics_registry,
+)
+
+
+class RequestMetricsMiddleware:
+    """记录每个HTTP请求的结果（状态码）和处理时间 由install_service_routes启用"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        time_start = time.monotonic()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # 只用已定义的路由作为标签 避免任意路径产生大量时间序列
+            endpoint = scope["path"]
+            if endpoint not in {route.path for route in scope["app"].routes}:
+                endpoint = "other"
+            requests_total.labels(endpoint, scope["method"], str(status)).inc()
+            request_duration_seconds.labels(endpoint, scope["method"]).observe(
+                time.monotonic() - time_start
+            )
+
+
+def metrics_response() -> Response:
+    return Response(generate_latest(metrics_registry), media_type=CONTENT_TYPE_LATEST)
+
+
+# [外部工具的查找]
+
+# 查询各工具版本的参数 未列出的工具使用`--version`
+_VERSION_ARGS = {
+    "yosys": ["-V"],
+    "iverilog": ["-V"],
+    "vvp": ["-V"],
+    "sta": ["-version"],
+}
+
+
+class Toolchain:
+    """
+    服务用到的外部工具的绝对路径和版本 在服务启动时通过discover查找一次
+    之后run_tool直接使用绝对路径运行 不必每次请求都在PATH中查找
+    """
+
+    def __init__(self):
+        self.required = []
+        self.paths = {}
+        self.versions = {}
+
+    def path(self, name: str) -> Union[str, None]:
+        """工具的绝对路径 找不到时为None 未经discover的工具在第一次用到时查找"""
+        if name not in self.paths:
+            path = shutil.which(name)
+            self.paths[name] = os.path.abspath(path) if path is not None else None
+        return self.paths[name]
+
+    def resolve(self, name: str) -> str:
+        """run_tool运行的程序 找不到时原样返回 由运行时的错误说明原因"""
+        if os.path.isabs(name):
+            return name
+        path = self.path(name)
+        return path if path is not None else name
+
+    def missing(self, names: Union[List[str], None] = None) -> List[str]:
+        """names（默认为discover时指定的工具）中找不到的工具"""
+        return [
+            name
+            for name in (self.required if names is None else names)
+            if self.path(name) is None
+        ]
+
+    async def discover(self, names: List[str]):
+        """在服务的startup事件中调用 查找names中的工具并查询版本"""
+        self.required = list(names)
+        for name in names:
+            self.paths.pop(name, None)
+            path = self.path(name)
+            if path is None:
+                logger.error(f"找不到外部工具{name}")
+                continue
+            completed = await run_tool([path, *_VERSION_ARGS.get(name, ["--version"])])
+            output = (completed.stdout + completed.stderr).decode("utf-8", "replace")
+            self.versions[name] = output.strip().split("\n")[0]
+            logger.info(f"外部工具{name}：{path} {self.versions[name]}")
+
+    def report(self) -> Dict[str, Dict[str, Union[str, None]]]:
+        """各工具的路径和版本 用于就绪检查"""
+        return {
+            name: {"path": self.path(name), "version": self.versions.get(name, "")}
+            for name in self.required
+        }
+
+
+tools = Toolchain()
+
+
+class ToolchainBusyError(Exception):
+    """
+    等待运行的外部工具进程已达MAX_QUEUED_TOOLS 由admit_request或未经admit_request的run_tool抛出
+    retry_after: 建议多少秒后重试
+    """
+
+    def __init__(self, tool: str, queue_depth: int, retry_after: int):
+        super().__init__(
+            f"toolchain busy: {queue_depth} processes waiting, cannot run {tool} now"
+        )
+        self.tool = tool
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+
+
+class ToolResult(subprocess.CompletedProcess):
+    """
+    run_tool的结果 与`subprocess.run(args, capture_output=True)`的返回值相同，另外记录排队的情况
+    queue_depth: 开始排队时已在等待的进程数
+    wait_seconds: 排队等待的时间
+    cached: 结果来自缓存 没有运行进程
+    verdict: 进程超出资源上限时为TIME_LIMIT_EXCEEDED或OUTPUT_LIMIT_EXCEEDED 否则为空
+    run_seconds: 进程从启动到结束的时间
+    rusage: 进程（及其已结束的子进程）的资源占用 见`os.wait4` 结果来自缓存时为None
+    """
+
+    def __init__(
+        self,
+        args,
+        returncode,
+        stdout=b"",
+        stderr=b"",
+        queue_depth: int = 0,
+        wait_seconds: float = 0.0,
+        cached: bool = False,
+        verdict: str = "",
+        run_seconds: float = 0.0,
+        rusage: Union[resource.struct_rusage, None] = None,
+    ):
+        super().__init__(args, returncode, stdout, stderr)
+        self.queue_depth = queue_depth
+        self.wait_seconds = wait_seconds
+        self.cached = cached
+        self.verdict = verdict
+        self.run_seconds = run_seconds
+        self.rusage = rusage
+
+    def queue_log(self) -> str:
+        """写入过程日志的排队和运行情况"""
+        tool = os.path.basename(self.args[0])
+        if self.cached:
+            return f"""{tool}：使用缓存的结果\n"""
+        log = f"""{tool}：排队{self.wait_seconds:.3f}秒，开始排队时有{self.queue_depth}个进程在等待，运行{self.run_seconds:.3f}秒"""
+        if self.rusage is not None:
+            cpu_seconds = self.rusage.ru_utime + self.rusage.ru_stime
+            # Linux上ru_maxrss的单位为KiB
+            log += f"""（CPU时间{cpu_seconds:.3f}秒，内存峰值{self.rusage.ru_maxrss / 1024:.1f}MiB）"""
+        return log + "\n"
+
+
+class _ToolPool:
+    """一个事件循环中的外部工具进程池 asyncio.Semaphore需要在事件循环中创建"""
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_TOOLS)
+        self.tool_semaphores = {}
+        self.waiting = 0
+        # 各工具运行时间的滑动平均 用于估计重试的时间
+        self.durations = {}
+
+    def tool_semaphore(self, tool: str) -> asyncio.Semaphore:
+        semaphore = self.tool_semaphores.get(tool)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(max_concurrent(tool))
+            self.tool_semaphores[tool] = semaphore
+        return semaphore
+
+    def record_duration(self, tool: str, seconds: float):
+        average = self.durations.get(tool)
+        self.durations[tool] = (
+            seconds if average is None else 0.8 * average + 0.2 * seconds
+        )
+
+    def retry_after(self, tool: str) -> int:
+        # 排在前面的进程大约需要这么久才能全部开始运行
+        seconds = self.durations.get(tool, 1.0) * self.waiting / MAX_CONCURRENT_TOOLS
+        return max(1, math.ceil(seconds))
+
+
+_tool_pools = weakref.WeakKeyDictionary()
+
+
+def _tool_pool() -> _ToolPool:
+    loop = asyncio.get_running_loop()
+    pool = _tool_pools.get(loop)
+    if pool is None:
+        pool = _ToolPool()
+        _tool_pools[loop] = pool
+    return pool
+
+
+# 当前请求已通过admit_request 通过asyncio.gather等创建的task也继承这个值
+_admitted = contextvars.ContextVar("admitted", default=False)
+
+
+def admit_request(tool: str):
+    """
+    在请求运行第一个外部工具之前调用 等待运行的进程已达MAX_QUEUED_TOOLS时抛出ToolchainBusyError
+    通过之后本请求中的run_tool只排队不拒绝 请求不会在运行了一部分工具、写了一部分文件之后才被拒绝
+    tool: 请求最先运行的工具 用于估计重试的时间和监控指标
+    """
+    pool = _tool_pool()
+    if pool.waiting >= MAX_QUEUED_TOOLS:
+        tool_rejected_total.labels(tool).inc()
+        raise ToolchainBusyError(tool, pool.waiting, pool.retry_after(tool))
+    _admitted.set(True)
+
+
+def _limit_args(limits: ResourceLimits) -> List[str]:
+    """
+    通过prlimit设置资源上限的命令前缀 prlimit设置后exec外部工具 进程号不变
+    不使用preexec_fn 它在fork之后、exec之前运行Python代码 在多线程的进程中并不安全
+    """
+    path = tools.path("prlimit")
+    if path is None:
+        return []
+    args = [path]
+    for option, which, value in [
+        ("--cpu", resource.RLIMIT_CPU, limits.cpu_seconds),
+        ("--as", resource.RLIMIT_AS, limits.memory_bytes),
+        ("--fsize", resource.RLIMIT_FSIZE, limits.output_bytes),
+    ]:
+        if value <= 0:
+            continue
+        _, hard = resource.getrlimit(which)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        # 只设置软上限（`soft:`） 超出时进程收到SIGXCPU/SIGXFSZ 据此区分超时、超出输出上限和其他错误
+        args.append(f"{option}={value}:")
+    return [*args, "--"]
+
+
+def _spawn_process(args: List[str], cwd: Union[str, None]) -> subprocess.Popen:
+    """在线程中启动进程 fork和exec大型的服务进程需要一段时间 不阻塞事件循环"""
+    return subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        # 单独的进程组 超时或取消时连同工具创建的子进程一起结束
+        start_new_session=True,
+    )
+
+
+def _discard_spawned(spawning: asyncio.Future):
+    """启动进程时请求被取消 进程启动后立即结束并回收"""
+    if spawning.cancelled() or spawning.exception() is not None:
+        return
+    process = spawning.result()
+    _kill_process_group(process.pid)
+    _process_waiters.submit(_wait_process, process, 0)
+
+
+def _kill_process_group(pid: int):
+    """结束进程及其创建的所有子进程"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class _BoundedBuffer:
+    """只保留前limit字节的输出 之后的输出只计数"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+        self.dropped = 0
+
+    def write(self, data: bytes):
+        kept = data[: max(0, self.limit - self.size)]
+        if kept:
+            self.chunks.append(kept)
+            self.size += len(kept)
+        self.dropped += len(data) - len(kept)
+
+    def getvalue(self) -> bytes:
+        data = b"".join(self.chunks)
+        if self.dropped == 0:
+            return data
+        # 在换行处截断 避免截断半个UTF-8字符
+        newline = data.rfind(b"\n")
+        if newline >= 0:
+            self.dropped += len(data) - newline - 1
+            data = data[: newline + 1]
+        return data + f"""\n（之后的{self.dropped}字节输出未保留）\n""".encode("utf-8")
+
+
+def _exit_code(status: int) -> int:
+    """与subprocess相同 被信号结束时为负的信号值"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _wait_process(process: subprocess.Popen, buffer_bytes: int):
+    """
+    在线程中读取进程的stdout和stderr直到其结束 返回(returncode, stdout, stderr, rusage)
+    自行用`os.wait4`回收进程以得到其资源占用
+    """
+    buffers = {
+        process.stdout: _BoundedBuffer(buffer_bytes),
+        process.stderr: _BoundedBuffer(buffer_bytes),
+    }
+    result = None
+    with selectors.DefaultSelector() as selector:
+        for stream in buffers:
+            os.set_blocking(stream.fileno(), False)
+            selector.register(stream, selectors.EVENT_READ)
+        while selector.get_map():
+            # 进程结束但其子进程仍持有管道时也能及时返回
+            for key, _ in selector.select(timeout=0.05):
+                data = os.read(key.fd, 65536)
+                if data:
+                    buffers[key.fileobj].write(data)
+                else:
+                    selector.unregister(key.fileobj)
+            if result is None:
+                pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+                if pid != 0:
+                    result = (status, rusage)
+                    # 结束进程遗留的子进程 之后管道很快会关闭
+                    _kill_process_group(process.pid)
+    if result is None:
+        _, status, rusage = os.wait4(process.pid, 0)
+        result = (status, rusage)
+    status, rusage = result
+    process.returncode = _exit_code(status)
+    process.stdout.close()
+    process.stderr.close()
+    return (
+        process.returncode,
+        buffers[process.stdout].getvalue(),
+        buffers[process.stderr].getvalue(),
+        rusage,
+    )
+
+
+# 启动和等待外部工具进程的线程 run_tool已限制同时运行的进程数
+_process_waiters = ThreadPoolExecutor(
+    max_workers=MAX_CONCURRENT_TOOLS, thread_name_prefix="run_tool"
+)
+
+
+def _limit_verdict(returncode: int, timed_out: bool) -> str:
+    if timed_out or returncode == -signal.SIGXCPU:
+        return TIME_LIMIT_EXCEEDED
+    if returncode == -signal.SIGXFSZ:
+        return OUTPUT_LIMIT_EXCEEDED
+    return ""
+
+
+async def run_tool(
+    args: List[str],
+    cwd: Union[str, None] = None,
+    limits: Union[ResourceLimits, None] = None,
+) -> ToolResult:
+    """
+    不经过shell直接运行外部工具，等待其结束并收集stdout和stderr（各保留TOOL_OUTPUT_BUFFER_BYTES字节）
+    同时运行的进程数受MAX_CONCURRENT_TOOLS和各工具的上限限制，超出时排队
+    排队的进程数已达MAX_QUEUED_TOOLS时抛出ToolchainBusyError 已通过admit_request的请求则继续排队
+    进程的资源上限默认为resource_limits(tool) 超出时结束整个进程组，返回的verdict说明原因
+    """
+    pool = _tool_pool()
+    tool = os.path.basename(args[0])
+    args = [tools.resolve(args[0]), *args[1:]]
+    if limits is None:
+        limits = resource_limits(tool)
+    wall_timeout = limits.wall_seconds if limits.wall_seconds > 0 else None
+    queue_depth = pool.waiting
+    if queue_depth >= MAX_QUEUED_TOOLS and not _admitted.get():
+        tool_rejected_total.labels(tool).inc()
+        raise ToolchainBusyError(tool, queue_depth, pool.retry_after(tool))
+
+    time_queued = time.monotonic()
+    pool.waiting += 1
+    tool_queued.labels(tool).inc()
+    waiting = True
+    try:
+        async with pool.tool_semaphore(tool), pool.semaphore:
+            pool.waiting -= 1
+            tool_queued.labels(tool).dec()
+            waiting = False
+            time_started = time.monotonic()
+            with tool_processes.labels(tool).track_inprogress():
+                loop = asyncio.get_running_loop()
+                spawning = loop.run_in_executor(
+                    _process_waiters, _spawn_process, _limit_args(limits) + args, cwd
+                )
+                try:
+                    process = await asyncio.shield(spawning)
+                except asyncio.CancelledError:
+                    spawning.add_done_callback(_discard_spawned)
+                    raise
+                waiter = loop.run_in_executor(
+                    _process_waiters,
+                    _wait_process,
+                    process,
+                    TOOL_OUTPUT_BUFFER_BYTES,
+                )
+                timed_out = False
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout=wall_timeout)
+                except asyncio.TimeoutError:
+                    _kill_process_group(process.pid)
+                    timed_out = True
+                except asyncio.CancelledError:
+                    # 请求被取消时不留下孤儿进程
+                    _kill_process_group(process.pid)
+                    await waiter
+                    raise
+                returncode, stdout, stderr, rusage = await waiter
+            run_seconds = time.monotonic() - time_started
+            pool.record_duration(tool, run_seconds)
+    finally:
+        if waiting:
+            pool.waiting -= 1
+            tool_queued.labels(tool).dec()
+
+    tool_queue_wait_seconds.labels(tool).observe(time_started - time_queued)
+    tool_cpu_seconds_total.labels(tool, "user").inc(rusage.ru_utime)
+    tool_cpu_seconds_total.labels(tool, "system").inc(rusage.ru_stime)
+
+    # 超出上限的原因附在stderr后 各服务原有的出错信息中就能看到
+    verdict = _limit_verdict(returncode, timed_out)
+    if verdict == TIME_LIMIT_EXCEEDED:
+        message = f"""{tool}运行超时（CPU时间上限{limits.cpu_seconds}秒，墙钟时间上限{limits.wall_seconds:g}秒），已结束"""
+        stderr += f"""\n{message}\n""".encode("utf-8")
+    elif verdict == OUTPUT_LIMIT_EXCEEDED:
+        message = f"""{tool}输出的文件超出上限（{limits.output_bytes}字节），已结束"""
+        stderr += f"""\n{message}\n""".encode("utf-8")
+    return ToolResult(
+        args,
+        returncode,
+        stdout,
+        stderr,
+        queue_depth=queue_depth,
+        wait_seconds=time_started - time_queued,
+        verdict=verdict,
+        run_seconds=run_seconds,
+        rusage=rusage,
+    )
+
+
+# [过程日志]
+
+# 输出到容器stdout的日志 级别由LOG_LEVEL配置 外部工具的输出只在DEBUG级别输出
+logger = logging.getLogger("verilogoj")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(_handler)
+    logger.propagate = False
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# 随响应返回的过程日志的长度上限（字符数） 超出时保留开头和结尾 省略中间部分 为0时不限制
+LOG_MAX_CHARS = int(os.environ.get("LOG_MAX_CHARS", 256 * 1024))
+
+
+class ProcessLog:
+    """
+    一次请求的过程日志 随响应返回 用`str(log)`取得内容
+    info: 写入处理进度 同时以INFO级别输出
+    write: 写入外部工具的输出等大段内容 只以DEBUG级别输出
+    总长度超出max_chars时保留开头和结尾各一半，省略中间部分；每次写入的开销只与写入的长度有关
+    """
+
+    def __init__(self, max_chars: int = LOG_MAX_CHARS):
+        self.max_chars = max_chars
+        self.head = []
+        self.head_chars = 0
+        self.tail = collections.deque()
+        self.tail_chars = 0
+        self.omitted_chars = 0
+
+    def info(self, text: str):
+        logger.info(text.rstrip("\n"))
+        self._append(text)
+
+    def write(self, text: str):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(text.rstrip("\n"))
+        self._append(text)
+
+    def tool(self, completed: ToolResult):
+        """写入外部工具的排队、运行情况和stdout"""
+        self.info(completed.queue_log())
+        self.write(completed.stdout.decode("utf-8", "replace") + "\n")
+
+    def _append(self, text: str):
+        if self.max_chars <= 0:
+            self.head.append(text)
+            return
+        if not self.tail:
+            room = (self.max_chars - self.max_chars // 2) - self.head_chars
+            if room > 0:
+                self.head.append(text[:room])
+                self.head_chars += min(room, len(text))
+                text = text[room:]
+        if not text:
+            return
+        self.tail.append(text)
+        self.tail_chars += len(text)
+        # 结尾部分只保留最近的max_chars // 2个字符（多出的在取得内容时截掉） max_chars为1时结尾部分为空
+        while self.tail and self.tail_chars - len(self.tail[0]) >= self.max_chars // 2:
+            self.tail_chars -= len(self.tail[0])
+            self.omitted_chars += len(self.tail.popleft())
+
+    def copy(self) -> "ProcessLog":
+        log = ProcessLog(self.max_chars)
+        log.head = list(self.head)
+        log.head_chars = self.head_chars
+        log.tail = collections.deque(self.tail)
+        log.tail_chars = self.tail_chars
+        log.omitted_chars = self.omitted_chars
+        return log
+
+    def __str__(self) -> str:
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        omitted_chars = self.omitted_chars
+        if self.max_chars > 0 and len(tail) > self.max_chars // 2:
+            omitted_chars += len(tail) - self.max_chars // 2
+            tail = tail[len(tail) - self.max_chars // 2 :]
+        if omitted_chars == 0:
+            return head + tail
+        return head + f"""\n……（省略{omitted_chars}个字符）……\n""" + tail
+
+
+# [阶段耗时]
+
+
+class StageTiming(BaseModel):
+    name: str = Body(title="阶段名称")
+    seconds: float = Body(title="阶段耗时（秒，单调时钟） 外部工具为排队和运行的时间之和")
+    wait_seconds: float = Body(default=0.0, title="外部工具排队等待的时间（秒）")
+    user_seconds: float = Body(default=0.0, title="外部工具进程的用户态CPU时间（秒）")
+    system_seconds: float = Body(default=0.0, title="外部工具进程的内核态CPU时间（秒）")
+    cached: bool = Body(default=False, title="外部工具的结果来自缓存 没有运行进程")
+
+
+class StageTimer:
+    """
+    一次请求各阶段的耗时 用`timer.timings()`取得随响应返回的列表
+    每个阶段结束时输出一行JSON格式的INFO日志（带endpoint、request_id和part），便于从线上日志中统计耗时最多的阶段
+    stage: 用`with timer.stage(name):`计时一段代码
+    tool: 记录一次外部工具的运行 包括排队时间和子进程的CPU时间
+    """
+
+    def __init__(
+        self, endpoint: str, request_id: Union[str, None] = None, part: str = ""
+    ):
+        self.endpoint = endpoint
+        self.request_id = request_id or uuid.uuid4().hex[:12]
+        self.part = part
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        time_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(StageTiming(name=name, seconds=time.monotonic() - time_start))
+
+    def tool(self, name: str, completed: ToolResult):
+        rusage = completed.rusage
+        self.record(
+            StageTiming(
+                name=name,
+                seconds=completed.wait_seconds + completed.run_seconds,
+                wait_seconds=completed.wait_seconds,
+                user_seconds=rusage.ru_utime if rusage is not None else 0.0,
+                system_seconds=rusage.ru_stime if rusage is not None else 0.0,
+                cached=completed.cached,
+            )
+        )
+
+    def record(self, timing: StageTiming):
+        self.stages.append(timing)
+        stage_duration_seconds.labels(self.endpoint, timing.name).observe(
+            timing.seconds
+        )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                json.dumps(
+                    {
+                        "event": "stage",
+                        "endpoint": self.endpoint,
+                        "request_id": self.request_id,
+                        "part": self.part,
+                        **timing.dict(),
+                    },
+                    ensure_ascii=False,
+                )
+            )
+
+    def fork(self, part: str) -> "StageTimer":
+        """同一请求中单独计时的一部分（如一个测试点） 不含已记录的阶段"""
+        return StageTimer(self.endpoint, self.request_id, part)
+
+    def copy(self, part: Union[str, None] = None) -> "StageTimer":
+        """复制已记录的阶段 之后记录的阶段互不影响"""
+        timer = self.fork(self.part if part is None else part)
+        timer.stages = list(self.stages)
+        return timer
+
+    def timings(self) -> List[StageTiming]:
+        return list(self.stages)
+
+
+# [工作目录]
+
+
+class WorkspaceManager:
+    """
+    每个请求在root下的单独文件夹中保存上传的文件和外部工具的输出，请求结束后删除
+    root: 工作目录的根文件夹 可以放在tmpfs（如`/dev/shm/`）上减少磁盘读写
+    keep_on_failure: 请求出错时保留其文件夹 便于排查问题（之后仍会被定期清理）
+    max_age_seconds: 定期清理时删除修改时间早于此的文件夹，为0时不按时间清理
+    max_bytes: 定期清理时文件夹的总大小超出此值则从最旧的开始删除，为0时不按大小清理
+    sweep_interval_seconds: 定期清理的间隔
+    """
+
+    def __init__(
+        self,
+        root: str,
+        keep_on_failure: bool,
+        max_age_seconds: float,
+        max_bytes: int,
+        sweep_interval_seconds: float,
+    ):
+        self.root = root
+        self.keep_on_failure = keep_on_failure
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.sweep_interval_seconds = sweep_interval_seconds
+        # 正在使用的文件夹及其创建时间 清理时跳过
+        # 超过max_age_seconds仍未释放的视为遗漏了release（如流式响应未开始就断开） 照常清理
+        self.active = {}
+        self._sweeper = None
+
+    def create(self) -> str:
+        """新建一个工作目录 返回以`/`结尾的路径 用完后需要调用release"""
+        path = os.path.join(self.root, uuid.uuid4().hex) + "/"
+        os.makedirs(path)
+        self.active[path] = time.time()
+        return path
+
+    def release(self, path: str, failed: bool = False):
+        self.active.pop(path, None)
+        if failed and self.keep_on_failure:
+            logger.warning(f"保留出错请求的工作目录 {path}")
+            return
+        shutil.rmtree(path, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def workspace(self):
+        """`with workspaces.workspace() as base_path:` 块结束时删除工作目录 抛出异常时视为出错"""
+        path = self.create()
+        try:
+            yield path
+        except BaseException:
+            self.release(path, failed=True)
+            raise
+        self.release(path)
+
+    def sweep(self):
+        """删除过期的和超出总大小的文件夹 包括keep_on_failure保留的和服务异常退出时遗留的"""
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return
+        now = time.time()
+        active = {
+            path
+            for path, created in list(self.active.items())
+            if self.max_age_seconds <= 0 or now - created <= self.max_age_seconds
+        }
+        folders = []
+        for entry in entries:
+            path = os.path.join(self.root, entry.name) + "/"
+            if path in active or not entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+            if self.max_age_seconds > 0 and now - mtime > self.max_age_seconds:
+                self._remove(path)
+            else:
+                folders.append((mtime, path))
+
+        sizes = {path: _folder_size(path) for _, path in folders}
+        total_bytes = sum(sizes.values()) + sum(_folder_size(path) for path in active)
+        if self.max_bytes > 0:
+            for _, path in sorted(folders):
+                if total_bytes <= self.max_bytes:
+                    break
+                self._remove(path)
+                total_bytes -= sizes[path]
+        workspace_bytes.set(total_bytes)
+
+    def _remove(self, path: str):
+        self.active.pop(path, None)
+        shutil.rmtree(path, ignore_errors=True)
+
+    async def _sweep_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # 遍历文件夹可能较慢 放到线程池中执行
+            await loop.run_in_executor(None, self.sweep)
+            await asyncio.sleep(self.sweep_interval_seconds)
+
+    def start_sweeper(self):
+        """在服务的startup事件中调用 启动定期清理"""
+        if self._sweeper is None and self.sweep_interval_seconds > 0:
+            self._sweeper = asyncio.ensure_future(self._sweep_periodically())
+
+    async def stop_sweeper(self):
+        """在服务的shutdown事件中调用"""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+
+def _folder_size(path: str) -> int:
+    size = 0
+    for folder, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.lstat(os.path.join(folder, file_name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+workspaces = WorkspaceManager(
+    root=os.environ.get("WORKSPACE_DIR", "./temp/"),
+    keep_on_failure=os.environ.get("WORKSPACE_KEEP_ON_FAILURE", "0") == "1",
+    max_age_seconds=float(os.environ.get("WORKSPACE_MAX_AGE_SECONDS", 60 * 60)),
+    max_bytes=int(os.environ.get("WORKSPACE_MAX_BYTES", 1024 * 1024 * 1024)),
+    sweep_interval_seconds=float(
+        os.environ.get("WORKSPACE_SWEEP_INTERVAL_SECONDS", 5 * 60)
+    ),
+)
+workspaces_active.set_function(lambda: len(workspaces.active))
+
+
+# [编译结果缓存]
+
+
+class FileCache:
+    """
+    以内容的sha256为键的文件缓存，同样的输入只需要生成一次文件
+    cache_dir: 缓存文件所在的文件夹
+    max_bytes: 缓存占用磁盘的上限，超出后按最久未使用的顺序淘汰，为0时不缓存
+    suffix: 缓存文件的扩展名
+    name: 监控指标中缓存的名称
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, suffix: str, name: str):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.name = name
+
+    @staticmethod
+    def key(*parts: Union[str, bytes]) -> str:
+        h = hashlib.sha256()
+        # 各部分之间用\0分隔 避免不同的拼接方式得到相同的键
+        for part in parts:
+            h.update(part.encode("utf-8") if isinstance(part, str) else part)
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def lookup(self, key: str, target_path: str) -> bool:
+        """命中时将缓存的文件放到target_path并返回True"""
+        hit = self._link(key, target_path)
+        cache_lookups_total.labels(self.name, "hit" if hit else "miss").inc()
+        return hit
+
+    def _link(self, key: str, target_path: str) -> bool:
+        entry_path = self._entry_path(key)
+        try:
+            # 硬链接到本次请求的文件夹 之后即使缓存被淘汰也不影响本次请求
+            os.link(entry_path, target_path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            try:
+                shutil.copyfile(entry_path, target_path)
+            except FileNotFoundError:
+                return False
+        try:
+            os.utime(entry_path)  # 记录最近一次使用 用于淘汰
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, key: str, path: str):
+        """
+        将path放入缓存 path此后不能再被修改
+        会访问磁盘并扫描缓存文件夹 在协程中应通过`run_in_threadpool`调用
+        """
+        if self.max_bytes <= 0 or os.path.getsize(path) > self.max_bytes:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # 先放到临时文件再改名 并发的请求不会读到写了一半的文件
+        temp_path = self._entry_path(key) + f".{uuid.uuid4().hex}.tmp"
+        try:
+            # 与lookup相同 优先使用硬链接 不复制文件内容
+            os.link(path, temp_path)
+        except OSError:
+            shutil.copyfile(path, temp_path)
+        os.replace(temp_path, self._entry_path(key))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(self.suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        cache_bytes.labels(self.name).set(total_bytes)
+
+
+# iverilog编译出的vvp程序的缓存
+program_cache = FileCache(
+    cache_dir=os.environ.get("PROGRAM_CACHE_DIR", "./cache/program/"),
+    max_bytes=int(os.environ.get("PROGRAM_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    suffix=".vvp",
+    name="program",
+)
+
+# testbench中`$dumpfile(`DUMP_FILE_NAME)`的文件名
+# 编译时固定为相对路径 运行时通过vvp的工作目录决定波形文件的位置 同样的代码编译出的程序可以复用
+DUMP_FILE_NAME = "dump.vcd"
+
+
+async def iverilog_version() -> str:
+    """`iverilog -V`输出的第一行 服务启动时已查询过"""
+    if "iverilog" not in tools.versions:
+        await tools.discover(sorted(set(tools.required) | {"iverilog"}))
+    return tools.versions.get("iverilog", "")
+
+
+async def compile_verilog(source_paths: List[str], program_path: str) -> ToolResult:
+    """
+    用iverilog将source_paths编译为vvp程序program_path
+    以源文件内容、iverilog版本和宏定义为键缓存编译结果，命中时不运行iverilog，返回的cached为True
+    """
+    defines = [f'''DUMP_FILE_NAME="{DUMP_FILE_NAME}"''']
+    args = ["iverilog", *source_paths]
+    for define in defines:
+        args += ["-D", define]
+    args += ["-o", program_path]
+
+    parts = [await iverilog_version(), *defines]
+    for source_path in source_paths:
+        with open(source_path, "rb") as f:
+            parts.append(f.read())
+    key = FileCache.key(*parts)
+    if program_cache.lookup(key, program_path):
+        return ToolResult(args, 0, cached=True)
+
+    completed = await run_tool(args)
+    if completed.returncode == 0 and os.path.exists(program_path):
+        await run_in_threadpool(program_cache.store, key, program_path)
+    return completed
+
+
+async def run_simulation(program_path: str, vcd_path: str) -> ToolResult:
+    """
+    用vvp运行compile_verilog编译出的程序，波形输出到vcd_path
+    vvp在单独的文件夹中运行，结束后将其中的波形文件移动到vcd_path
+    """
+    run_path = vcd_path + ".run"
+    os.makedirs(run_path, exist_ok=True)
+    try:
+        completed = await run_tool(["vvp", os.path.abspath(program_path)], cwd=run_path)
+        dump_path = os.path.join(run_path, DUMP_FILE_NAME)
+        if os.path.exists(dump_path):
+            os.replace(dump_path, vcd_path)
+    finally:
+        shutil.rmtree(run_path, ignore_errors=True)
+    return completed
+
+
+# [服务的公共路由]
+
+
+def install_service_routes(
+    app: FastAPI, tool_names: List[str], service_error: Type[BaseModel]
+):
+    """
+    为服务注册各服务共用的部分：请求监控、启动时查找外部工具（tool_names）、工作目录的定期清理、
+    `/healthz` `/readyz` `/metrics`，以及ToolchainBusyError转为503的处理
+    service_error为服务的错误信息模型 需要有error和log两个字段
+    """
+    app.add_middleware(RequestMetricsMiddleware)
+
+    @app.on_event("startup")
+    async def start_workspace_sweeper():
+        workspaces.start_sweeper()
+
+    @app.on_event("startup")
+    async def discover_tools():
+        await tools.discover([*tool_names, "prlimit"])
+
+    @app.on_event("shutdown")
+    async def stop_workspace_sweeper():
+        await workspaces.stop_sweeper()
+
+    @app.get("/healthz")
+    async def healthz():
+        """存活检查 服务进程能响应即返回200"""
+        return {"status": "ok"}
+
+    @app.get("/readyz")
+    async def readyz():
+        """就绪检查 所需的外部工具都已找到时返回200 否则返回503 反向代理据此不再将请求转发到此容器"""
+        missing = tools.missing()
+        return JSONResponse(
+            status_code=503 if missing else 200,
+            content={"ready": not missing, "missing": missing, "tools": tools.report()},
+        )
+
+    @app.get("/metrics")
+    async def metrics():
+        """Prometheus格式的监控指标 包括请求数、各阶段耗时、外部工具进程数、缓存命中率等"""
+        return metrics_response()
+
+    @app.exception_handler(ToolchainBusyError)
+    async def toolchain_busy_handler(request: Request, e: ToolchainBusyError):
+        """等待运行的外部工具过多时直接拒绝请求 客户端应在Retry-After秒后重试"""
+        return await http_exception_handler(
+            request,
+            HTTPException(
+                status_code=503,
+                detail=service_error(
+                    error=f"服务繁忙，请{e.retry_after}秒后重试\n{str(e)}", log=""
+                ).json(),
+                headers={"Retry-After": str(e.retry_after)},
+            ),
+        )
@@ -1,12 +1,21 @@
-from typing import Union, List
-import subprocess
+from typing import List, Union
 import os
-import uuid
 from datetime import datetime
 
 from fastapi import FastAPI, Body, HTTPException
 from pydantic import BaseModel
 
+from toolchain import (
+    ProcessLog,
+    StageTimer,
+    StageTiming,
+    admit_request,
+    install_service_routes,
+    run_tool,
+    tools,
+    workspaces,
+)
+
 # ------------------------
 
 
@@ -28,6 +37,9 @@ class ServiceResponse(BaseModel):
     # sdf_content: str = Body(title="标准延时文件内容（opensta的write_sdf命令得到）")
 
     log: str = Body(title="过程日志")
+    timings: Union[List[StageTiming], None] = Body(
+        default=None, title="各阶段的耗时", description="按各阶段结束的先后顺序排列"
+    )
 
 
 class ServiceError(BaseModel):
@@ -41,6 +53,9 @@ class ServiceError(BaseModel):
 app = FastAPI()
 
 
+install_service_routes(app, ["yosys", "sta", "netlistsvg"], ServiceError)
+
+
 @app.post(
     path="/",
     # https://fastapi.tiangolo.com/advanced/additional-responses/
@@ -55,78 +70,68 @@ app = FastAPI()
         },
     },
 )
-def get_google130nm_analysis(service_request: ServiceRequest):
-    log_temp = f"""开始处理 {datetime.now().strftime("%Y/%m/%d, %H:%M:%S")}
-请求：{service_request}\n"""
-    log = log_temp
-    print(log_temp)
+async def get_google130nm_analysis(service_request: ServiceRequest):
+    log = ProcessLog()
+    timer = StageTimer("/")
+    log.info(f"""开始处理 {datetime.now().strftime("%Y/%m/%d, %H:%M:%S")}\n""")
+    # 请求中包含全部Verilog源文件 只以DEBUG级别输出
+    log.write(f"""请求：{service_request}\n""")
 
     # [判断宿主机程序存在]
 
-    def program_exists(program_name: str) -> Union[str, None]:
-        """Check whether `name` is on PATH and marked as executable."""
-        from shutil import which
-
-        return which(program_name) is not None
-
-    if not program_exists("yosys"):
+    if tools.path("yosys") is None:
         raise HTTPException(
             status_code=404,
-            detail=ServiceError(error="yosys not installed", log=log).json(),
+            detail=ServiceError(error="yosys not installed", log=str(log)).json(),
         )
-    log_temp = f"""yosys已安装\n"""
-    log += log_temp
-    print(log_temp)
+    log.info(f"""yosys已安装\n""")
 
-    if not program_exists("sta"):
+    if tools.path("sta") is None:
         raise HTTPException(
             status_code=404,
-            detail=ServiceError(error="opensta not installed", log=log).json(),
+            detail=ServiceError(error="opensta not installed", log=str(log)).json(),
         )
-    log_temp = f"""opensta已安装\n"""
-    log += log_temp
-    print(log_temp)
+    log.info(f"""opensta已安装\n""")
 
-    if not program_exists("netlistsvg"):
+    if tools.path("netlistsvg") is None:
         raise HTTPException(
             status_code=404,
-            detail=ServiceError(error="netlistsvg not installed", log=log).json(),
+            detail=ServiceError(error="netlistsvg not installed", log=str(log)).json(),
         )
-    log_temp = f"""netlistsvg已安装\n"""
-    log += log_temp
-    print(log_temp)
+    log.info(f"""netlistsvg已安装\n""")
+    admit_request("yosys")
 
     # [保存用户上传的verilog源文件]
 
-    processing_id = uuid.uuid4().hex  # https://docs.python.org/3/library/uuid.html
-    base_path = f"./temp/{processing_id}/"
-    verilog_sources_folder = "verilog_sources/"
-    if service_request.verilog_sources.count == 0:
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(error="no verilog sources provided", log=log).json(),
-        )
-    verilog_sources_path = []
-    for i, verilog_source in enumerate(service_request.verilog_sources):
-        verilog_source_path = base_path + verilog_sources_folder + str(i) + ".v"
-        verilog_sources_path.append(verilog_source_path)
-        os.makedirs(os.path.dirname(verilog_source_path), exist_ok=True)
-        with open(verilog_source_path, "w") as f:
-            f.write(verilog_source)
-
-    log_temp = f"""Verilog源文件已保存\n"""
-    log += log_temp
-    print(log_temp)
-
-    # [生成yosys脚本]
-
-    output_info_path = base_path + "info.txt"
-    google_130nm_lib_path = "./lib/sky130_fd_sc_hd__tt_025C_1v80.lib"
-
-    yosys_show_svg_path = base_path + "circuit_bad"
-    yosys_verilog_path = base_path + "module.v"
-    yosys_json_path = base_path + "module.json"
-    yosys_script_content = f"""
+    with workspaces.workspace() as base_path:
+        with timer.stage("write_sources"):
+            verilog_sources_folder = "verilog_sources/"
+            if service_request.verilog_sources.count == 0:
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error="no verilog sources provided", log=str(log)
+                    ).json(),
+                )
+            verilog_sources_path = []
+            for i, verilog_source in enumerate(service_request.verilog_sources):
+                verilog_source_path = base_path + verilog_sources_folder + str(i) + ".v"
+                verilog_sources_path.append(verilog_source_path)
+                os.makedirs(os.path.dirname(verilog_source_path), exist_ok=True)
+                with open(verilog_source_path, "w") as f:
+                    f.write(verilog_source)
+
+        log.info(f"""Verilog源文件已保存\n""")
+
+        # [生成yosys脚本]
+
+        output_info_path = base_path + "info.txt"
+        google_130nm_lib_path = "./lib/sky130_fd_sc_hd__tt_025C_1v80.lib"
+
+        yosys_show_svg_path = base_path + "circuit_bad"
+        yosys_verilog_path = base_path + "module.v"
+        yosys_json_path = base_path + "module.json"
+        yosys_script_content = f"""
 read -sv {" ".join(verilog_sources_path)}
 synth -top {service_request.top_module}
 read_liberty -lib {google_130nm_lib_path}
@@ -136,111 +141,97 @@ show -notitle -stretch -format svg -prefix {yosys_show_svg_path}
 write_verilog {yosys_verilog_path}
 write_json {yosys_json_path}
     """.strip()
-    yosys_show_svg_path += ".svg"
-
-    yosys_script_path = base_path + "synth.ys"
-    os.makedirs(os.path.dirname(yosys_script_path), exist_ok=True)
-    with open(yosys_script_path, "w") as f:
-        f.write(yosys_script_content)
-
-    log_temp = f"""yosys脚本已生成\n"""
-    log += log_temp
-    print(log_temp)
-
-    # [运行yosys脚本]
-
-    completed_yosys = subprocess.run(
-        [f"yosys {yosys_script_path}"],  # 注意这里块不能分开写 否则yosys会进入交互模式
-        capture_output=True,
-        shell=True,
-    )  # https://docs.python.org/3/library/subprocess.html#subprocess.run
-    log += completed_yosys.stdout.decode("utf-8")
-    if completed_yosys.returncode != 0:
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(
-                error=f"run yosys failed\n{completed_yosys.stderr.decode('utf-8')}",
-                log=log,
-            ).json(),
+        yosys_show_svg_path += ".svg"
+
+        yosys_script_path = base_path + "synth.ys"
+        os.makedirs(os.path.dirname(yosys_script_path), exist_ok=True)
+        with open(yosys_script_path, "w") as f:
+            f.write(yosys_script_content)
+
+        log.info(f"""yosys脚本已生成\n""")
+
+        # [运行yosys脚本]
+
+        completed_yosys = await run_tool(["yosys", yosys_script_path])
+        log.tool(completed_yosys)
+        timer.tool("yosys", completed_yosys)
+        if completed_yosys.returncode != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error=f"run yosys failed\n{completed_yosys.stderr.decode('utf-8')}",
+                    log=str(log),
+                ).json(),
+            )
+
+        log.info(f"""yosys脚本成功运行\n""")
+
+        # [从yosys的标准输出中正则提取到资源占用情况]
+
+        with open(output_info_path, "r") as f:
+            resources_report = f.read().replace("5. Printing statistics.", "").strip()
+        log.info(f"""资源报告已提取\n""")
+
+        # [读取yosys`show`命令得到的svg]
+
+        with open(yosys_show_svg_path, "r") as f:
+            yosys_show_svg = f.read()
+
+        # [netlistsvg]
+        netlistsvg_default_path = base_path + "netlist_default.svg"
+        netlistsvg_google130_path = base_path + "netlist_default.svg"
+        google130nm_skin_path = "./google130nm/google130nm_skin.svg"
+        completed_netlistsvg_default = await run_tool(
+            [
+                "netlistsvg",
+                f"{yosys_json_path}",
+                "-o",
+                f"{netlistsvg_default_path}",
+            ],
         )
-
-    log_temp = f"""yosys脚本成功运行\n"""
-    log += log_temp
-    print(log_temp)
-
-    # [从yosys的标准输出中正则提取到资源占用情况]
-
-    with open(output_info_path, "r") as f:
-        resources_report = f.read().replace("5. Printing statistics.", "").strip()
-    log_temp = f"""资源报告已提取\n"""
-    log += log_temp
-    print(log_temp)
-
-    # [读取yosys`show`命令得到的svg]
-
-    with open(yosys_show_svg_path, "r") as f:
-        yosys_show_svg = f.read()
-
-    # [netlistsvg]
-    netlistsvg_default_path = base_path + "netlist_default.svg"
-    netlistsvg_google130_path = base_path + "netlist_default.svg"
-    google130nm_skin_path = "./google130nm/google130nm_skin.svg"
-    completed_netlistsvg_default = subprocess.run(
-        [
-            "netlistsvg",
-            f"{yosys_json_path}",
-            "-o",
-            f"{netlistsvg_default_path}",
-        ],
-        capture_output=True,
-    )
-    completed_netlistsvg_google130nm = subprocess.run(
-        [
-            "netlistsvg",
-            f"{yosys_json_path}",
-            "-o",
-            f"{netlistsvg_google130_path}",
-            "--skin",
-            f"{google130nm_skin_path}",
-        ],
-        capture_output=True,
-    )
-    log += (
-        completed_netlistsvg_default.stdout.decode("utf-8")
-        + "\n"
-        + completed_netlistsvg_google130nm.stdout.decode("utf-8")
-    )
-    if (
-        completed_netlistsvg_default.returncode != 0
-        or completed_netlistsvg_google130nm.returncode != 0
-    ):
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(
-                error=f"run netlistsvg failed {completed_netlistsvg_default.stderr.decode('utf-8')}\n{completed_netlistsvg_google130nm.stderr.decode('utf-8')}",
-                log=log,
-            ).json(),
+        completed_netlistsvg_google130nm = await run_tool(
+            [
+                "netlistsvg",
+                f"{yosys_json_path}",
+                "-o",
+                f"{netlistsvg_google130_path}",
+                "--skin",
+                f"{google130nm_skin_path}",
+            ],
         )
-    log_temp = f"""netlistsvg已生成\n"""
-    log += log_temp
-    print(log_temp)
-
-    # [读取netlistsvg]
-
-    with open(netlistsvg_default_path, "r") as f:
-        netlistsvg_default = f.read()
-    with open(netlistsvg_google130_path, "r") as f:
-        netlistsvg_google130nm = f.read()
-
-    log_temp = f"""netlistsvg已提取\n"""
-    log += log_temp
-    print(log_temp)
-
-    # [生成OpenSTA脚本]
-
-    # sdf_path = base_path + "sta.sdf"
-    google_130nm_lib_path = "./lib/sky130_fd_sc_hd__tt_025C_1v80.lib"
-    opensta_script_content = f"""
+        log.tool(completed_netlistsvg_default)
+        timer.tool("netlistsvg_default", completed_netlistsvg_default)
+        log.tool(completed_netlistsvg_google130nm)
+        timer.tool("netlistsvg_google130nm", completed_netlistsvg_google130nm)
+        if (
+            completed_netlistsvg_default.returncode != 0
+            or completed_netlistsvg_google130nm.returncode != 0
+        ):
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error=f"run netlistsvg failed {completed_netlistsvg_default.stderr.decode('utf-8')}\n{completed_netlistsvg_google130nm.stderr.decode('utf-8')}",
+                    log=str(log),
+                ).json(),
+            )
+        log.info(f"""netlistsvg已生成\n""")
+
+        # [读取netlistsvg]
+
+        with open(netlistsvg_default_path, "r") as f:
+            netlistsvg_default = f.read()
+        with open(netlistsvg_google130_path, "r") as f:
+            netlistsvg_google130nm = f.read()
+
+        log.info(f"""netlistsvg已提取\n""")
+
+        # [生成OpenSTA脚本]
+
+        # sdf_path = base_path + "sta.sdf"
+        # 时序分析结果写入文件 不从可能被截断的标准输出中提取
+        sta_report_path = base_path + "sta_report.txt"
+        google_130nm_lib_path = "./lib/sky130_fd_sc_hd__tt_025C_1v80.lib"
+        opensta_script_content = f"""
 read_liberty {google_130nm_lib_path}
 read_verilog {yosys_verilog_path}
 link_design inverter
@@ -249,63 +240,56 @@ create_clock -name clk -period 10
 set_input_delay -clock clk 0 {{*}}
 set_output_delay -clock clk 0 {{*}}
 
-report_checks
+report_checks > {sta_report_path}
     """.strip()
-# write_sdf {sdf_path}
-
-    opensta_script_path = base_path + "sta.txt"
-    os.makedirs(os.path.dirname(opensta_script_path), exist_ok=True)
-    with open(opensta_script_path, "w") as f:
-        f.write(opensta_script_content)
-
-    log_temp = f"""OpenSTA脚本已生成\n"""
-    log += log_temp
-    print(log_temp)
-
-    # [执行OpenSTA脚本]
-
-    completed_sta = subprocess.run(
-        [f"sta -no_splash -exit {opensta_script_path}"],
-        capture_output=True,
-        shell=True,
-    )  # https://docs.python.org/3/library/subprocess.html#subprocess.run
-    log += completed_sta.stdout.decode("utf-8")
-    if completed_sta.returncode != 0:
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(
-                error=f"run sta failed\n{completed_sta.stderr.decode('utf-8')}",
-                log=log,
-            ).json(),
-        )
+        # write_sdf {sdf_path}
 
-    log_temp = f"""OpenSTA脚本成功运行\n"""
-    log += log_temp
-    print(log_temp)
+        opensta_script_path = base_path + "sta.txt"
+        os.makedirs(os.path.dirname(opensta_script_path), exist_ok=True)
+        with open(opensta_script_path, "w") as f:
+            f.write(opensta_script_content)
 
-    # [拿到sta分析结果]
+        log.info(f"""OpenSTA脚本已生成\n""")
 
-    sta_report = completed_sta.stdout.decode("utf-8")
+        # [执行OpenSTA脚本]
 
-    log_temp = f"""取得时序分析结果\n"""
-    log += log_temp
-    print(log_temp)
-
-    # [拿到sdf文件内容]
-
-    # with open(sdf_path, "r") as f:
-    #     sdf_content = f.read()
-
-    # log_temp = f"""取得sdf内容\n"""
-    # log += log_temp
-    # print(log_temp)
-
-    return ServiceResponse(
-        log=log,
-        resources_report=resources_report,
-        yosys_show_svg=yosys_show_svg,
-        netlistsvg_default=netlistsvg_default,
-        netlistsvg_google130nm=netlistsvg_google130nm,
-        sta_report=sta_report,
-        # sdf_content=sdf_content,
-    )
+        completed_sta = await run_tool(
+            ["sta", "-no_splash", "-exit", opensta_script_path]
+        )
+        log.tool(completed_sta)
+        timer.tool("sta", completed_sta)
+        if completed_sta.returncode != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error=f"run sta failed\n{completed_sta.stderr.decode('utf-8')}",
+                    log=str(log),
+                ).json(),
+            )
+
+        log.info(f"""OpenSTA脚本成功运行\n""")
+
+        # [拿到sta分析结果]
+
+        with open(sta_report_path, "r") as f:
+            sta_report = f.read()
+
+        log.info(f"""取得时序分析结果\n""")
+
+        # [拿到sdf文件内容]
+
+        # with open(sdf_path, "r") as f:
+        #     sdf_content = f.read()
+
+        # log.info(f"""取得sdf内容\n""")
+
+        return ServiceResponse(
+            log=str(log),
+            timings=timer.timings(),
+            resources_report=resources_report,
+            yosys_show_svg=yosys_show_svg,
+            netlistsvg_default=netlistsvg_default,
+            netlistsvg_google130nm=netlistsvg_google130nm,
+            sta_report=sta_report,
+            # sdf_content=sdf_content,
+        )
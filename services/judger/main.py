@@ -1,18 +1,53 @@
-from typing import Union, List
-import subprocess
+from typing import Union, List, NamedTuple, Tuple
+import asyncio
 import os
-import uuid
+import time
 from datetime import datetime
 
 from fastapi import FastAPI, Body, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from prometheus_client import Counter
 from pydantic import BaseModel
 
+from toolchain import (
+    FileCache,
+    ProcessLog,
+    StageTimer,
+    StageTiming,
+    ToolResult,
+    admit_request,
+    cache_lookups_total,
+    compile_verilog,
+    install_service_routes,
+    logger,
+    metrics_registry,
+    run_simulation,
+    tools,
+    workspaces,
+)
+
 # ------------
 
+# [监控指标]
+
+vcd_parsed_bytes_total = Counter(
+    "verilogoj_vcd_parsed_bytes",
+    "解析的vcd文件大小之和",
+    registry=metrics_registry,
+)
+judge_results_total = Counter(
+    "verilogoj_judge_results",
+    "判题结果 verdict为correct wrong time_limit_exceeded output_limit_exceeded error skipped之一",
+    ["endpoint", "verdict"],
+    registry=metrics_registry,
+)
+
 # [wavedump.py]
 
 
-from pyDigitalWaveTools.vcd.parser import VcdParser
+from pyDigitalWaveTools.vcd.parser import VcdParser, VcdColumnarSeries, is_glob
+from pyDigitalWaveTools.vcd.value_format import vcdValueToBitVector
 
 
 class VcdSignalTraversalError(Exception):
@@ -23,50 +58,178 @@ class VcdSignalComparationError(Exception):
     pass
 
 
-def find_signal_inst(data_obj, signal_path):
-    components = signal_path.split("/")
-    cur = data_obj
-    for i in range(0, len(components) - 1):
-        if cur["name"] != components[i]:
-            raise VcdSignalTraversalError(
-                "{} mismatch with {} while traversing {}".format(
-                    cur["name"], components[i], signal_path
-                )
-            )
+def testbench_signal_paths(signal_names: List[str]) -> List[str]:
+    """testbench中的信号名称 -> 波形中的信号路径"""
+    return list(map(lambda name: f"root/testbench/{name}", signal_names))
 
-        if not "children" in cur.keys():
-            raise VcdSignalTraversalError(
-                "{} have no data k-v pair while traversing {}".format(
-                    cur["name"], signal_path
-                )
-            )
 
-        found = False
-        for child in cur["children"]:
-            if child["name"] == components[i + 1]:
-                found = True
-                cur = child
-                break
+class VcdWaveform:
+    """
+    解析后的vcd波形，VcdComparator和VcdConverter共用同一个对象，每个vcd文件只解析一次
+    vcd_path: vcd文件路径
+    signal_paths: 只保存这些信号的数据 为None时保存所有信号 可以使用通配符（如root/testbench/dut/*）
+    """
 
-        if not found:
-            raise VcdSignalTraversalError(
-                "{} have no children called {} while traversing {}".format(
-                    cur["name"], components[i + 1], signal_path
-                )
-            )
+    def __init__(self, vcd_path, signal_paths: Union[List[str], None] = None):
+        vcd = VcdParser(signal_filter=signal_paths, columnar=True)
+        vcd.parse_mmap(vcd_path)
+        vcd_parsed_bytes_total.inc(os.path.getsize(vcd_path))
+        self.vcd = vcd
+        self.signals = {}
 
-    if cur["name"] != components[-1]:
-        raise VcdSignalTraversalError(
-            "{} mismatch with {} while traversing {}".format(
-                cur["name"], components[-1], signal_path
-            )
+    def signal(self, signal_path):
+        """
+        按路径取得信号 返回{"name", "type": {"width", "name"}, "data"}
+        "data"直接引用列式存储的VcdColumnarSeries，它可以像(time, value)的list一样取长度、下标和遍历
+        """
+        sig_inst = self.signals.get(signal_path)
+        if sig_inst is None:
+            var = self.vcd.find(signal_path)
+            if var is None:
+                raise VcdSignalTraversalError(
+                    "no signal called {} in the waveform".format(signal_path)
+                )
+            sig_inst = {
+                "name": var.name,
+                "type": {"width": var.width, "name": var.sigType},
+                "data": var.data,
+            }
+            self.signals[signal_path] = sig_inst
+        return sig_inst
+
+    def has(self, signal_path: str) -> bool:
+        """波形中是否有这个信号"""
+        return signal_path in self.signals or self.vcd.find(signal_path) is not None
+
+    def expand(self, signal_paths: List[str]) -> List[str]:
+        """将通配符展开为波形中实际的信号路径 没有通配符的路径原样保留"""
+        paths = []
+        for signal_path in signal_paths:
+            if is_glob(signal_path):
+                selected = self.vcd.select(signal_path)
+                if not selected:
+                    raise VcdSignalTraversalError(
+                        "no signal matches {} in the waveform".format(signal_path)
+                    )
+                paths += [self.vcd.var_path(var) for var in selected]
+            else:
+                paths.append(signal_path)
+        return paths
+
+
+class VcdMismatch(NamedTuple):
+    """
+    一段参考与学生信号值不同的时间区间[start, end)
+    end为None表示一直持续到仿真结束
+    ref/ud为区间开始时两者的值 尚未出现过值变化时为None
+    """
+
+    signal: str
+    start: int
+    end: Union[int, None]
+    ref: Union[str, None]
+    ud: Union[str, None]
+
+    def __str__(self):
+        if self.end is None:
+            when = "from time {} to the end".format(self.start)
+        else:
+            when = "from time {} to {}".format(self.start, self.end)
+        return "Signal {} have difference {} (ref={}, ud={})".format(
+            self.signal, when, self.ref, self.ud
         )
 
-    return cur
+
+def settled_changes(data):
+    """同一时刻的多次值变化只保留最后一次（即该时刻稳定后的值）"""
+    it = iter(data)
+    prev = next(it, None)
+    if prev is None:
+        return
+    for cur in it:
+        if cur[0] != prev[0]:
+            yield prev
+        prev = cur
+    yield prev
+
+
+def signal_mismatches(name, data_ref, data_ud, limit):
+    """
+    将两个信号按时间归并对齐，返回至多limit个值不同的时间区间（VcdMismatch）
+    只比较信号在每个时刻的值，因此重复的值变化不影响结果
+    学生的值变化比参考多或少时，多出或缺少的部分同样作为区间报告
+    """
+    mismatches = []
+    if limit <= 0:
+        return mismatches
+    # 常见的情况是波形完全相同 整体比较一次即可
+    if len(data_ref) == len(data_ud) and list(data_ref) == list(data_ud):
+        return mismatches
+
+    it_ref = settled_changes(data_ref)
+    it_ud = settled_changes(data_ud)
+    change_ref = next(it_ref, None)
+    change_ud = next(it_ud, None)
+    value_ref = value_ud = None
+    mismatch = None  # 当前尚未结束的区间
+    while change_ref is not None or change_ud is not None:
+        if change_ud is None or (
+            change_ref is not None and change_ref[0] <= change_ud[0]
+        ):
+            time = change_ref[0]
+        else:
+            time = change_ud[0]
+        if change_ref is not None and change_ref[0] == time:
+            value_ref = change_ref[1]
+            change_ref = next(it_ref, None)
+        if change_ud is not None and change_ud[0] == time:
+            value_ud = change_ud[1]
+            change_ud = next(it_ud, None)
+
+        if value_ref != value_ud:
+            if mismatch is None:
+                mismatch = VcdMismatch(name, time, None, value_ref, value_ud)
+        elif mismatch is not None:
+            mismatches.append(mismatch._replace(end=time))
+            mismatch = None
+            if len(mismatches) >= limit:
+                return mismatches
+
+    if mismatch is not None:
+        mismatches.append(mismatch)
+    return mismatches
+
+
+def canonical_changes(data):
+    """
+    (time, value) -> (time, 规范化的值)
+    规范化的值与格式无关（'b0'与'b000'相同），见vcdValueToBitVector
+    """
+    if isinstance(data, VcdColumnarSeries):
+        return list(data.canonical_changes())
+    return [(time, vcdValueToBitVector(value)) for time, value in data]
+
+
+def format_canonical_value(value, width):
+    """将规范化的值按信号位宽写回vcd中的格式 如(0b10, 0b01), 3 -> 'b01x'"""
+    if value is None or not isinstance(value, tuple):
+        return value
+    val, xz_mask = value
+    bits = []
+    for i in range(width - 1, -1, -1):
+        v = (val >> i) & 1
+        if (xz_mask >> i) & 1:
+            bits.append("z" if v else "x")
+        else:
+            bits.append("1" if v else "0")
+    if width == 1:
+        return bits[0]
+    return "b" + "".join(bits)
 
 
 class VcdComparator:
-    def compare_signals(self, ref, ud):
+    def compare_signals(self, ref, ud, limit):
+        """返回两个信号至多limit个不一致的区间"""
         # compare width
         if ref["type"]["width"] != ud["type"]["width"]:
             raise VcdSignalComparationError(
@@ -78,70 +241,213 @@ class VcdComparator:
         # No need to compare sigType (reg/wire.. anything else?)
 
         # signal comparation
-        # TODO: support for different types ('b0' with 'b000' or 'd0' or something...)
-
-        # Since value change dump theoretically only generates data when changes
-        # so direct diffing should work
-        for i, val in enumerate(ref["data"]):
-            if ud["data"][i] != val:
-                raise VcdSignalComparationError(
-                    "Signal {} have difference on time {} (ref={}, ud={})".format(
-                        ref["name"], val[0], val, ud["data"][i]
-                    )
-                )
+        # 比较规范化后的值 'b0'与'b000'、'bx'与'bxxx'视为相同
+        width = ref["type"]["width"]
+        mismatches = signal_mismatches(
+            ref["name"],
+            canonical_changes(ref["data"]),
+            canonical_changes(ud["data"]),
+            limit,
+        )
+        return [
+            m._replace(
+                ref=format_canonical_value(m.ref, width),
+                ud=format_canonical_value(m.ud, width),
+            )
+            for m in mismatches
+        ]
 
     def dump_hierarchy(self, data_obj):
         # TODO: only dump names
         print(data_obj.toJSON())
 
-    def __init__(self, vcd_ref, vcd_ut, signal_names):
+    def __init__(self, waveform_ref, waveform_ut, signal_names, max_mismatches=10):
         """
         Initialize signals for comparation
-        vcd_ref: the reference vcd file
-        vcd_ut: the vcd file under test
+        waveform_ref: the reference VcdWaveform
+        waveform_ut: the VcdWaveform under test
         signal_names: the signal for comparation, uses "/" to express hierarchy.
                 and the top module name shall also be included.
+                glob patterns such as "root/testbench/dut/*" are expanded on waveform_ref.
+                signals missing from waveform_ut (e.g. internal nets of a student design
+                with different names) are reported as differences.
+        max_mismatches: at most this many mismatches are reported
         """
 
-        with open(vcd_ref) as vcd_ref_file:
-            vcd = VcdParser()
-            vcd.parse(vcd_ref_file)
-            self.data_ref = vcd.scope.toJson()
-            print(self.data_ref)
-
-        with open(vcd_ut) as vcd_ut_file:
-            vcd_ut = VcdParser()
-            vcd_ut.parse(vcd_ut_file)
-            self.data_ut = vcd_ut.scope.toJson()
-            print(self.data_ut)
+        self.waveform_ref = waveform_ref
+        self.waveform_ut = waveform_ut
+        self.max_mismatches = max_mismatches
+        self.mismatches = []
 
         # find all signals
-        self.signals_ref = [find_signal_inst(self.data_ref, i) for i in signal_names]
-        self.signals_ut = [find_signal_inst(self.data_ut, i) for i in signal_names]
+        signal_names = waveform_ref.expand(signal_names)
+        self.missing = [i for i in signal_names if not waveform_ut.has(i)]
+        signal_names = [i for i in signal_names if i not in self.missing]
+        self.signals_ref = [waveform_ref.signal(i) for i in signal_names]
+        self.signals_ut = [waveform_ut.signal(i) for i in signal_names]
 
     def compare(self):
+        # 多找一处 用于判断是否还有没列出的不一致
+        limit = self.max_mismatches + 1
+        self.mismatches = []
         try:
             # compare all signals
             for i in range(0, len(self.signals_ref)):
-                self.compare_signals(self.signals_ref[i], self.signals_ut[i])
-            return (True, "无误\n")
+                if len(self.mismatches) >= limit:
+                    break
+                self.mismatches += self.compare_signals(
+                    self.signals_ref[i],
+                    self.signals_ut[i],
+                    limit - len(self.mismatches),
+                )
         except VcdSignalComparationError as e:
             return (False, "有误\n{}\n".format(e))
+        truncated = len(self.mismatches) > self.max_mismatches
+        del self.mismatches[self.max_mismatches :]
+        if not self.mismatches and not self.missing:
+            return (True, "无误\n")
+        msg = "有误\n"
+        for signal_name in self.missing:
+            msg += "Signal {} does not exist in ud\n".format(signal_name)
+        for mismatch in self.mismatches:
+            msg += "{}\n".format(mismatch)
+        if truncated:
+            msg += "（只列出前{}处不一致）\n".format(self.max_mismatches)
+        return (False, msg)
 
 
 # [vcd_main.py]
 
+import bisect
+import functools
 import json
+import math
 
 
 class VcdSignalValueParseError(Exception):
     pass
 
 
+class WaveTimeAxis:
+    """
+    WaveJSON的时间轴：仿真时间 -> 波形字符串中的列
+    时间轴由若干段显示区间组成，区间之间被折叠的部分各占一列，写入间隔标记"|"
+    times: 所有要显示的值变化时刻
+    compact: 按所有值变化时刻的最大公约数缩放时间轴（如`timescale 1ns`下都是`#10`的延时时缩小为1/10）
+    max_idle: 缩放后超过这么多列都没有任何信号变化的区间折叠为一个间隔标记 为None时不折叠
+    windows: 只显示这些仿真时间区间[begin, end]内的波形 为None时显示全部
+    """
+
+    def __init__(
+        self,
+        times,
+        compact: bool = False,
+        max_idle: Union[int, None] = None,
+        windows: Union[List[Tuple[int, int]], None] = None,
+    ):
+        times = sorted(set(times))
+        self.period = 1
+        if compact:
+            self.period = functools.reduce(math.gcd, times, 0) or 1
+        period = self.period
+        scaled_times = [time // period for time in times]
+
+        # 要显示的区间（缩放后） 合并重叠和相邻的区间
+        if windows is None:
+            spans = [(0, None)]
+        else:
+            spans = []
+            for begin, end in sorted(windows):
+                begin = max(begin, 0) // period
+                end = -(-end // period)
+                if spans and begin <= spans[-1][1] + 1:
+                    spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+                else:
+                    spans.append((begin, end))
+
+        # 各段显示区间的起止时刻（缩放后 含end end为None表示一直到最后）与起始列
+        self.segment_times = []
+        self.segment_ends = []
+        self.segment_columns = []
+        # 间隔标记所在的列
+        self.gap_columns = []
+        column = 0
+        prev_end = -1
+        for begin, end in spans:
+            # 在长时间没有变化的地方再把显示区间分开
+            starts = [begin]
+            ends = []
+            if max_idle is not None:
+                prev = begin
+                lo = bisect.bisect_left(scaled_times, begin)
+                hi = len(scaled_times)
+                if end is not None:
+                    hi = bisect.bisect_right(scaled_times, end)
+                for time in scaled_times[lo:hi]:
+                    if time - prev > max_idle:
+                        ends.append(prev)
+                        starts.append(time)
+                    prev = time
+            ends.append(end)
+
+            for start, stop in zip(starts, ends):
+                if start > prev_end + 1:
+                    self.gap_columns.append(column)
+                    column += 1
+                self.segment_times.append(start)
+                self.segment_ends.append(stop)
+                self.segment_columns.append(column)
+                if stop is None:
+                    break
+                column += stop - start + 1
+                prev_end = stop
+        if self.segment_ends[-1] is not None:
+            self.gap_columns.append(column)
+
+    def locate(self, time: int) -> Tuple[int, int, bool]:
+        """
+        返回(列, 所在或之前最近的一段显示区间的下标, 是否在显示区间内)
+        不在显示区间内时 列为折叠后的间隔标记所在的列
+        """
+        time //= self.period
+        i = bisect.bisect_right(self.segment_times, time) - 1
+        if i < 0:
+            return self.gap_columns[0], i, False
+        start = self.segment_times[i]
+        end = self.segment_ends[i]
+        if end is None or time <= end:
+            return self.segment_columns[i] + time - start, i, True
+        return self.segment_columns[i] + end - start + 1, i, False
+
+    def column(self, time: int) -> int:
+        return self.locate(time)[0]
+
+    def idle(self, begin: int, end: int) -> str:
+        """列[begin, end)没有值变化时的波形字符串 其中间隔标记所在的列写入|"""
+        if end <= begin:
+            return ""
+        wave = ""
+        i = bisect.bisect_left(self.gap_columns, begin)
+        while i < len(self.gap_columns) and self.gap_columns[i] < end:
+            wave += "." * (self.gap_columns[i] - begin) + "|"
+            begin = self.gap_columns[i] + 1
+            i += 1
+        return wave + "." * (end - begin)
+
+
+def signal_change_times(sig_inst):
+    """信号所有值变化的时刻"""
+    data = sig_inst["data"]
+    if isinstance(data, VcdColumnarSeries):
+        return data.times
+    return [time for time, _ in data]
+
+
 class VcdConverter:
-    def __init__(self, data_vcd):
+    def __init__(self, waveform, time_axis: Union[WaveTimeAxis, None] = None):
         self.output = {"signal": []}
-        self.data_vcd = data_vcd
+        self.waveform = waveform
+        self.time_axis = WaveTimeAxis([]) if time_axis is None else time_axis
 
     def emitWaveDict(self):
         return self.output
@@ -152,38 +458,78 @@ class VcdConverter:
     def emitWaveJson(self):
         return json.dumps(self.output)
 
-    def parseValue(self, val_str):
-        """Note: b111xx1 -> x"""
-        if val_str[0] == "b":
-            if val_str.find("x") != -1:
-                return "x"
-            return int(val_str[1:], base=2)
-        elif len(val_str) == 1:
-            if val_str[0] == "x":
-                return "x"
-            else:
-                return int(val_str, base=2)
-        else:
+    def waveValue(self, value, width):
+        """
+        规范化的值 -> WaveJSON中的值 含x/z时整体视为"x"
+        如(0b101, 0) -> 5, (0b100, 0b010) -> "x"
+        """
+        if not isinstance(value, tuple):
             raise VcdSignalValueParseError("Unknown value type")
+        val, xz_mask = value
+        width_mask = (1 << width) - 1
+        if xz_mask & width_mask:
+            return "x"
+        return val & width_mask
 
-    def toBinRepr(self, val, width):
-        if val == "x":
-            return "x" * width
-
-        striped = bin(val)[2:]
-        assert width >= len(striped)
-        return "0" * (width - len(striped)) + striped
+    def waveEvents(self, sig_inst, wave_len):
+        """
+        返回[(step, value)]：信号的值在第step个时间片变为value（与上一个值不同）
+        每个时间片最多处理一次值变化，同一时刻的多次变化依次顺延到之后的时间片
+        在时间轴折叠掉的部分中的值变化不显示，最后的值在下一段显示区间的开头显示
+        """
+        width = sig_inst["type"]["width"]
+        time_axis = self.time_axis
+        local_time_max = time_axis.column(sig_inst["data"][-1][0])
+        events = []
+        cur_wave = None
+        step = -1
+        pending_wave = None
+        pending_segment = 0
+        for time, value in canonical_changes(sig_inst["data"]):
+            new_wave = self.waveValue(value, width)
+            column, segment, visible = time_axis.locate(time)
+            if pending_wave is not None and pending_segment <= segment:
+                pending_column = time_axis.segment_columns[pending_segment]
+                # 正好在显示区间开头的值变化会覆盖折叠部分中的值
+                if not visible or column != pending_column:
+                    step = max(pending_column, step + 1)
+                    if pending_wave != cur_wave:
+                        events.append((step, pending_wave))
+                        cur_wave = pending_wave
+                pending_wave = None
+            if not visible:
+                pending_wave = new_wave
+                pending_segment = segment + 1
+                continue
+
+            step = max(column, step + 1)
+            if step > local_time_max:
+                break
+            if new_wave != cur_wave:
+                events.append((step, new_wave))
+                cur_wave = new_wave
+
+        if pending_wave is not None and pending_segment < len(
+            time_axis.segment_columns
+        ):
+            step = max(time_axis.segment_columns[pending_segment], step + 1)
+            if step < wave_len and pending_wave != cur_wave:
+                events.append((step, pending_wave))
+        return events
 
     def addToWaveJsonSeparate(self, signal_names, prefix=""):
         # find common time_max
         time_max = 0
         for signal_name in signal_names:
-            sig_inst = find_signal_inst(self.data_vcd, signal_name)
+            sig_inst = self.waveform.signal(signal_name)
             time_max = max(time_max, sig_inst["data"][-1][0])
+        # [0, time_max + 1]
+        wave_len = self.time_axis.column(time_max) + 2
+        idle = self.time_axis.idle
 
         for signal_name in signal_names:
             sig_jsons = []
-            sig_inst = find_signal_inst(self.data_vcd, signal_name)
+            sig_inst = self.waveform.signal(signal_name)
 
             width = sig_inst["type"]["width"]
             # decompose
@@ -191,59 +537,30 @@ class VcdConverter:
                 sig_jsons.append({})
                 sig_jsons[i]["name"] = prefix + sig_inst["name"] + "[" + str(i) + "]"
 
-            local_time_max = sig_inst["data"][-1][0]
-            waves = ["" for i in range(0, width)]
-            cur_step_ptr = 0
-
-            # "x" or int or "SOME.."
-            cur_wave = "SOMETHING_NEVER_HAPPEN"
+            # 每一位只在值变化时写入 中间用连续的"."补齐
+            waves = [[] for i in range(0, width)]
+            last_steps = [-1] * width
+            cur_wave = None
 
-            # TODO: Avoid multiple transitions at same timestep
-            for time_i in range(0, local_time_max + 1):
-                if sig_inst["data"][cur_step_ptr][0] > time_i:
-                    # maintain current value
-                    for i in range(0, width):
-                        waves[i] += "."
+            for step, new_wave in self.waveEvents(sig_inst, wave_len):
+                if cur_wave is None or cur_wave == "x" or new_wave == "x":
+                    changed = range(0, width)
                 else:
-                    new_wave = self.parseValue(sig_inst["data"][cur_step_ptr][1])
-                    if new_wave == cur_wave:
-                        print(f"DEBUG width {width}")
-                        print(f"DEBUG local_time_max {local_time_max}")
-                        print(f"DEBUG new_wave {new_wave}")
-                        print(f"DEBUG cur_wave {cur_wave}")
-                        print(f"DEBUG waves {waves}")
-                        print(f"DEBUG i {i}")
-                        for i in range(0, width):
-                            waves[i] += "."
+                    diff = cur_wave ^ new_wave
+                    changed = [i for i in range(0, width) if (diff >> i) & 1]
+                for i in changed:
+                    if new_wave == "x":
+                        bit = "x"
                     else:
-                        # do bitwise comparation
-                        if cur_wave == "SOMETHING_NEVER_HAPPEN":
-                            # new_wave_bin[0] is MSB
-                            new_wave_bin = self.toBinRepr(new_wave, width)
-                            for i in range(0, width):
-                                waves[i] += new_wave_bin[::-1][i]
-                        else:
-                            cur_wave_bin = self.toBinRepr(cur_wave, width)
-                            new_wave_bin = self.toBinRepr(new_wave, width)
-
-                            for i in range(0, width):
-                                old = cur_wave_bin[::-1][i]
-                                new = new_wave_bin[::-1][i]
-                                if old != new:
-                                    waves[i] += new
-                                else:
-                                    waves[i] += "."
-
-                        cur_wave = new_wave
-
-                    cur_step_ptr += 1
-
-            for i in range(local_time_max, time_max + 1):
-                for i in range(0, width):
-                    waves[i] += "."
+                        bit = "1" if (new_wave >> i) & 1 else "0"
+                    waves[i].append(idle(last_steps[i] + 1, step))
+                    waves[i].append(bit)
+                    last_steps[i] = step
+                cur_wave = new_wave
 
             for i in range(0, width):
-                sig_jsons[i]["wave"] = waves[i]
+                waves[i].append(idle(last_steps[i] + 1, wave_len))
+                sig_jsons[i]["wave"] = "".join(waves[i])
 
             self.output["signal"] += sig_jsons
 
@@ -252,41 +569,28 @@ class VcdConverter:
         # find common time_max
         time_max = 0
         for signal_name in signal_names:
-            sig_inst = find_signal_inst(self.data_vcd, signal_name)
+            sig_inst = self.waveform.signal(signal_name)
             time_max = max(time_max, sig_inst["data"][-1][0])
+        # [0, time_max + 1]
+        wave_len = self.time_axis.column(time_max) + 2
+        idle = self.time_axis.idle
 
         for signal_name in signal_names:
             sig_json = {}
-            sig_inst = find_signal_inst(self.data_vcd, signal_name)
+            sig_inst = self.waveform.signal(signal_name)
             sig_json["name"] = prefix + sig_inst["name"]
 
-            # [0, time_max]
-            local_time_max = sig_inst["data"][-1][0]
-            wave = ""
-            cur_step_ptr = 0
-            cur_wave = "SOMETHING_NEVER_HAPPEN"
+            wave = []
+            last_step = -1
             data = []
-
-            # TODO: Avoid multiple transitions at same timestep
-            for i in range(0, local_time_max + 1):
-                if sig_inst["data"][cur_step_ptr][0] > i:
-                    # maintain current value
-                    wave += "."
-                else:
-                    new_wave = self.parseValue(sig_inst["data"][cur_step_ptr][1])
-                    if new_wave == cur_wave:
-                        wave += "."
-                    else:
-                        wave += "="
-                        data.append(new_wave)
-                        cur_wave = new_wave
-
-                    cur_step_ptr += 1
-
-            for i in range(local_time_max, time_max + 1):
-                wave += "."
-
-            sig_json["wave"] = wave
+            for step, new_wave in self.waveEvents(sig_inst, wave_len):
+                wave.append(idle(last_step + 1, step))
+                wave.append("=")
+                data.append(new_wave)
+                last_step = step
+            wave.append(idle(last_step + 1, wave_len))
+
+            sig_json["wave"] = "".join(wave)
             sig_json["data"] = data
 
             self.output["signal"].append(sig_json)
@@ -295,42 +599,233 @@ class VcdConverter:
 # [vcd_visualize.py]
 
 
-def vcd_visualize(
-    vcd_reference_path: str, vcd_student_path: str, signal_names: List[str]
-) -> str:
-    from pyDigitalWaveTools.vcd.parser import VcdParser
-
-    with open(vcd_reference_path) as f:
-        vcd = VcdParser()
-        vcd.parse(f)
-        data_reference = vcd.scope.toJson()
-
-    with open(vcd_student_path) as f:
-        vcd = VcdParser()
-        vcd.parse(f)
-        data_student = vcd.scope.toJson()
-
-    vc_reference = VcdConverter(data_reference)
-    vc_reference.addToWaveJsonSeparate(
-        list(map(lambda name: f"root/testbench/{name}", signal_names)), "reference_"
+class WaveJsonOptions(BaseModel):
+    compact: bool = Body(
+        default=False,
+        title="是否压缩波形图的时间轴",
+        description="按所有值变化时刻的最大公约数缩放时间轴，并将长时间没有任何信号变化的区间折叠为间隔标记`|`",
     )
-    vc_reference.addToWaveJsonAggregated(
-        list(map(lambda name: f"root/testbench/{name}", signal_names)), "reference_"
+    max_idle: int = Body(
+        default=20,
+        title="压缩时间轴时，超过这么多个时间片都没有信号变化的区间折叠为间隔标记",
     )
-
-    vc_student = VcdConverter(data_student)
-    vc_student.addToWaveJsonSeparate(
-        list(map(lambda name: f"root/testbench/{name}", signal_names)), "your_"
+    max_mismatches: int = Body(
+        default=10,
+        ge=1,
+        title="比较波形时最多列出这么多处不一致",
+        description="同时也是`mismatch_window`显示的不一致之处的个数",
+    )
+    mismatch_window: int = Body(
+        default=0,
+        title="波形不一致时只显示每处不一致（最多前`max_mismatches`处）前后这么长的仿真时间",
+        description="其余部分折叠为间隔标记`|`，为0时显示完整的波形",
     )
-    vc_student.addToWaveJsonAggregated(
-        list(map(lambda name: f"root/testbench/{name}", signal_names)), "your_"
+    skip_correct: bool = Body(
+        default=False, title="波形一致时不生成波形图", description="此时返回的wavejson为空字符串"
     )
 
+
+def vcd_visualize(
+    waveform_reference: VcdWaveform,
+    waveform_student: VcdWaveform,
+    signal_names: List[str],
+    options: Union[WaveJsonOptions, None] = None,
+    mismatches: Union[List[VcdMismatch], None] = None,
+) -> str:
+    """
+    生成答案和学生波形的WaveJSON
+    mismatches: VcdComparator找到的不一致之处 options.mismatch_window不为0时只显示它们附近的波形
+    """
+    if options is None:
+        options = WaveJsonOptions()
+    signal_paths = waveform_reference.expand(testbench_signal_paths(signal_names))
+    # 学生的设计中可能没有参考波形中的某些内部信号 只显示有的
+    signal_paths_student = [path for path in signal_paths if waveform_student.has(path)]
+
+    windows = None
+    if options.mismatch_window > 0 and mismatches:
+        windows = [
+            (m.start - options.mismatch_window, m.start + options.mismatch_window)
+            for m in mismatches
+        ]
+
+    # 答案和学生的波形共用同一个时间轴 保证上下对齐
+    time_axis = None
+    if options.compact or windows is not None:
+        times = set()
+        for waveform, paths in [
+            (waveform_reference, signal_paths),
+            (waveform_student, signal_paths_student),
+        ]:
+            for signal_path in paths:
+                times.update(signal_change_times(waveform.signal(signal_path)))
+        time_axis = WaveTimeAxis(
+            times,
+            compact=options.compact,
+            max_idle=options.max_idle if options.compact else None,
+            windows=windows,
+        )
+
+    vc_reference = VcdConverter(waveform_reference, time_axis)
+    vc_reference.addToWaveJsonSeparate(signal_paths, "reference_")
+    vc_reference.addToWaveJsonAggregated(signal_paths, "reference_")
+
+    vc_student = VcdConverter(waveform_student, time_axis)
+    vc_student.addToWaveJsonSeparate(signal_paths_student, "your_")
+    vc_student.addToWaveJsonAggregated(signal_paths_student, "your_")
+
     vc_reference.mergeWaveDict(vc_student.emitWaveDict())
     out = vc_reference.emitWaveJson()
     return out
 
 
+# [reference_cache.py]
+
+from collections import OrderedDict
+
+
+class ReferenceSimulationCache(FileCache):
+    """
+    参考代码仿真结果（reference.vcd）的缓存
+    以sha256(code_reference + testbench + signal_names)为键，同一道题的参考仿真只需要跑一次
+    解析后的参考波形（VcdWaveform）另外在内存中缓存，命中时连参考vcd的解析也可以跳过
+    cache_dir: 缓存文件所在的文件夹
+    max_bytes: 缓存占用磁盘的上限，超出后按最久未使用的顺序淘汰
+    max_waveforms: 内存中缓存的参考波形个数上限
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_waveforms: int):
+        super().__init__(cache_dir, max_bytes, ".vcd", "reference")
+        self.max_waveforms = max_waveforms
+        self.waveforms = OrderedDict()
+
+    @staticmethod
+    def key(code_reference: str, testbench: str, signal_names: List[str]) -> str:
+        return FileCache.key(code_reference, testbench, *sorted(set(signal_names)))
+
+    def get_waveform(self, key: str) -> Union[VcdWaveform, None]:
+        waveform = self.waveforms.get(key)
+        if waveform is not None:
+            self.waveforms.move_to_end(key)
+        cache_lookups_total.labels(
+            "reference_waveform", "miss" if waveform is None else "hit"
+        ).inc()
+        return waveform
+
+    def put_waveform(self, key: str, waveform: VcdWaveform):
+        if self.max_waveforms <= 0:
+            return
+        self.waveforms[key] = waveform
+        self.waveforms.move_to_end(key)
+        while len(self.waveforms) > self.max_waveforms:
+            self.waveforms.popitem(last=False)
+
+
+reference_cache = ReferenceSimulationCache(
+    cache_dir=os.environ.get("REFERENCE_CACHE_DIR", "./cache/reference/"),
+    max_bytes=int(os.environ.get("REFERENCE_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+    max_waveforms=int(os.environ.get("REFERENCE_CACHE_MAX_WAVEFORMS", 32)),
+)
+
+
+# [simulate.py]
+
+
+async def simulate(
+    code_path: str, testbench_path: str, simulation_program_path: str, vcd_path: str
+):
+    """
+    iverilog编译并用vvp运行仿真，波形输出到vcd_path
+    同样的代码编译出的程序会被缓存，此时不再运行iverilog
+    返回(completed_iverilog, completed_vvp) 编译失败时不运行仿真 completed_vvp为None
+    """
+    completed_iverilog = await compile_verilog(
+        [code_path, testbench_path], simulation_program_path
+    )
+    if completed_iverilog.returncode != 0:
+        return completed_iverilog, None
+    completed_vvp = await run_simulation(simulation_program_path, vcd_path)
+    return completed_iverilog, completed_vvp
+
+
+async def gather_or_cancel(*aws):
+    """
+    与asyncio.gather相同 但其中一个抛出异常时先取消并等待其余的再抛出
+    否则其余的仿真会在工作目录被删除后继续运行
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def check_simulation(
+    log: ProcessLog,
+    timer: StageTimer,
+    name: str,
+    completed_iverilog: ToolResult,
+    completed_vvp: Union[ToolResult, None],
+) -> bool:
+    """记录编译和仿真的输出与耗时 编译失败时没有运行仿真 返回两者是否都成功"""
+    log.tool(completed_iverilog)
+    timer.tool(f"iverilog_{name}", completed_iverilog)
+    if completed_vvp is None:
+        return False
+    log.tool(completed_vvp)
+    timer.tool(f"vvp_{name}", completed_vvp)
+    return completed_vvp.returncode == 0
+
+
+def simulation_stderr(
+    completed_iverilog: ToolResult, completed_vvp: Union[ToolResult, None]
+) -> str:
+    """编译失败时只有iverilog的输出"""
+    if completed_vvp is None:
+        return completed_iverilog.stderr.decode("utf-8")
+    return f"{completed_iverilog.stderr.decode('utf-8')}\n{completed_vvp.stderr.decode('utf-8')}"
+
+
+def simulation_verdict(
+    completed_iverilog: ToolResult, completed_vvp: Union[ToolResult, None]
+) -> str:
+    """仿真因超出资源上限而被结束时为`time_limit_exceeded`或`output_limit_exceeded` 否则为空"""
+    if completed_vvp is None:
+        return completed_iverilog.verdict
+    return completed_iverilog.verdict or completed_vvp.verdict
+
+
+def lookup_reference(
+    reference_cache_key: str, vcd_reference_path: str
+) -> Tuple[bool, Union[VcdWaveform, None]]:
+    """
+    先查内存中解析后的参考波形 未命中时再查磁盘上的参考vcd（命中时放到vcd_reference_path）
+    返回(是否命中, 内存中的参考波形) 两者都未命中时才需要仿真参考代码
+    """
+    waveform_reference = reference_cache.get_waveform(reference_cache_key)
+    if waveform_reference is not None:
+        return True, waveform_reference
+    return reference_cache.lookup(reference_cache_key, vcd_reference_path), None
+
+
+async def load_reference_waveform(
+    reference_cache_key: str,
+    vcd_reference_path: str,
+    signal_names: List[str],
+    waveform_reference: Union[VcdWaveform, None],
+) -> VcdWaveform:
+    """取得解析后的参考波形 waveform_reference为lookup_reference在内存中找到的波形 为None时解析vcd并放入内存"""
+    if waveform_reference is None:
+        waveform_reference = await run_in_threadpool(
+            VcdWaveform, vcd_reference_path, testbench_signal_paths(signal_names)
+        )
+        reference_cache.put_waveform(reference_cache_key, waveform_reference)
+    return waveform_reference
+
+
 # ------------
 
 app = FastAPI()
@@ -344,17 +839,31 @@ class ServiceRequest(BaseModel):
     )
     testbench: str = Body(title="测试样例的Verilog文件", description="顶层模块的名称必须为`testbench`")
     top_module: str = Body(title="顶层模块的名称，注意需要保证学生、答案的顶层模块和top_module相同")
+    wavejson_options: WaveJsonOptions = Body(
+        default=WaveJsonOptions(), title="波形图的生成选项"
+    )
 
 
 class ServiceResponse(BaseModel):
     is_correct: bool = Body(title="判题结果 true表示此测试点通过 wrong表示此测试点未通过")
     log: str = Body(title="过程日志")
     wavejson: str = Body(title="学生模块和答案模块的波形图")
+    timings: Union[List[StageTiming], None] = Body(
+        default=None, title="各阶段的耗时", description="按各阶段结束的先后顺序排列"
+    )
 
 
 class ServiceError(BaseModel):
     error: str = Body(title="错误信息")
     log: str = Body(title="过程日志")
+    verdict: str = Body(
+        default="",
+        title="仿真超出资源上限的原因",
+        description="`time_limit_exceeded`超时 `output_limit_exceeded`输出的波形文件过大 其他错误时为空",
+    )
+
+
+install_service_routes(app, ["iverilog", "vvp"], ServiceError)
 
 
 @app.post(
@@ -365,193 +874,896 @@ class ServiceError(BaseModel):
         400: {"model": ServiceError, "description": "程序内部出错"},
     },
 )
-def judge_student_code(service_request: ServiceRequest):
+async def judge_student_code(service_request: ServiceRequest):
     """上传学生的Verilog代码、答案、testbench并指定顶层模块，返回判题结果和信号波形图"""
 
-    log_temp = f"""开始处理 {datetime.now().strftime("%Y/%m/%d, %H:%M:%S")}\n"""
-    log = log_temp
-    print(log_temp)
+    log = ProcessLog()
+    timer = StageTimer("/")
+    log.info(f"""开始处理 {datetime.now().strftime("%Y/%m/%d, %H:%M:%S")}\n""")
 
     # [判断宿主机程序存在]
 
-    def program_exists(program_name: str) -> Union[str, None]:
-        """Check whether `name` is on PATH and marked as executable."""
-        from shutil import which
-
-        return which(program_name) is not None
-
-    if not program_exists("yosys"):
-        raise HTTPException(
-            status_code=404,
-            detail=ServiceError(error="yosys not installed", log=log).json(),
-        )
-    if not program_exists("iverilog"):
+    if tools.path("iverilog") is None:
         raise HTTPException(
             status_code=404,
-            detail=ServiceError(error="iverilog not installed", log=log).json(),
+            detail=ServiceError(error="iverilog not installed", log=str(log)).json(),
         )
 
-    log_temp = f"""仿真软件已安装\n"""
-    log += log_temp
-    print(log_temp)
+    log.info(f"""仿真软件已安装\n""")
+    # 排队等待的外部工具过多时在运行任何工具之前拒绝 通过后本请求的工具只排队不再被拒绝
+    admit_request("iverilog")
 
     # [保存: 学生提交的Verilog 答案的Verilog testbench]
 
-    processing_id = uuid.uuid4().hex
-    base_path = f"./temp/{processing_id}/"
+    with workspaces.workspace() as base_path:
+        with timer.stage("write_sources"):
+            code_student_path = base_path + "code_student.v"
+            if service_request.code_student == "":
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error="no verilog source provided (student)", log=str(log)
+                    ).json(),
+                )
+            os.makedirs(os.path.dirname(code_student_path), exist_ok=True)
+            with open(code_student_path, "w") as f:
+                f.write(service_request.code_student)
+
+            code_reference_path = base_path + "code_reference.v"
+            if service_request.code_reference == "":
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error="no verilog source provided (reference)", log=str(log)
+                    ).json(),
+                )
+            os.makedirs(os.path.dirname(code_reference_path), exist_ok=True)
+            with open(code_reference_path, "w") as f:
+                f.write(service_request.code_reference)
+
+            testbench_path = base_path + "testbench.v"
+            if service_request.testbench == "":
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error="no testbench provided", log=str(log)
+                    ).json(),
+                )
+            os.makedirs(os.path.dirname(testbench_path), exist_ok=True)
+            with open(testbench_path, "w") as f:
+                f.write(service_request.testbench)
+
+        log.info(f"""提交文件已保存\n""")
+
+        # [跑一遍参考和学生的仿真]
+        # iverilog ./temp_uuid/testbench.v ./temp_uuid/code_reference.v -o ./temp_uuid/simulation_program_reference
+        # vvp ./temp_uuid/simulation_program_reference
+        # mv out.vcd ./temp_uuid/reference.vcd
+        # 同一道题的参考仿真结果相同 命中缓存时跳过参考代码的仿真
+        # 参考代码与学生代码的仿真互不依赖 两条流水线并行执行
+
+        simulation_program_reference_path = base_path + "simulation_program_reference"
+        vcd_reference_path = base_path + "reference.vcd"
+        simulation_program_student_path = base_path + "simulation_program_student"
+        vcd_student_path = base_path + "student.vcd"
+
+        reference_cache_key = reference_cache.key(
+            code_reference=service_request.code_reference,
+            testbench=service_request.testbench,
+            signal_names=service_request.signal_names,
+        )
+        reference_cache_hit, waveform_reference = lookup_reference(
+            reference_cache_key, vcd_reference_path
+        )
+        if reference_cache_hit:
+            log.info(f"""参考代码仿真缓存命中 {reference_cache_key[:16]}\n""")
+        else:
+            log.info(f"""参考代码仿真缓存未命中 {reference_cache_key[:16]}\n""")
+
+        with timer.stage("simulate"):
+            simulate_student = simulate(
+                code_path=code_student_path,
+                testbench_path=testbench_path,
+                simulation_program_path=simulation_program_student_path,
+                vcd_path=vcd_student_path,
+            )
+            if reference_cache_hit:
+                (
+                    completed_iverilog_student,
+                    completed_vvp_student,
+                ) = await simulate_student
+            else:
+                (
+                    (completed_iverilog_reference, completed_vvp_reference),
+                    (completed_iverilog_student, completed_vvp_student),
+                ) = await gather_or_cancel(
+                    simulate(
+                        code_path=code_reference_path,
+                        testbench_path=testbench_path,
+                        simulation_program_path=simulation_program_reference_path,
+                        vcd_path=vcd_reference_path,
+                    ),
+                    simulate_student,
+                )
+
+        if not reference_cache_hit:
+            if not check_simulation(
+                log,
+                timer,
+                "reference",
+                completed_iverilog_reference,
+                completed_vvp_reference,
+            ):
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error=f"reference code simulating failed\n{simulation_stderr(completed_iverilog_reference, completed_vvp_reference)}",
+                        log=str(log),
+                    ).json(),
+                )
+
+            await run_in_threadpool(
+                reference_cache.store, reference_cache_key, vcd_reference_path
+            )
+
+        log.info(f"""参考代码仿真结束\n""")
+
+        # [检查学生代码的仿真结果]
+
+        if not check_simulation(
+            log,
+            timer,
+            "student",
+            completed_iverilog_student,
+            completed_vvp_student,
+        ):
+            verdict = simulation_verdict(
+                completed_iverilog_student, completed_vvp_student
+            )
+            judge_results_total.labels("/", verdict or "error").inc()
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error=f"student code simulating failed\n{simulation_stderr(completed_iverilog_student, completed_vvp_student)}",
+                    log=str(log),
+                    verdict=verdict,
+                ).json(),
+            )
+
+        log.info(f"""学生代码仿真结束\n""")
+
+        # [判断波形图是否一致]
+        # 解析波形是CPU密集的工作 放到线程池中执行 不阻塞事件循环
+
+        with timer.stage("parse_vcd_reference"):
+            waveform_reference = await load_reference_waveform(
+                reference_cache_key,
+                vcd_reference_path,
+                service_request.signal_names,
+                waveform_reference,
+            )
+        with timer.stage("parse_vcd_student"):
+            waveform_student = await run_in_threadpool(
+                VcdWaveform,
+                vcd_student_path,
+                testbench_signal_paths(service_request.signal_names),
+            )
+        with timer.stage("compare"):
+            try:
+                cmpr = VcdComparator(
+                    waveform_ref=waveform_reference,
+                    waveform_ut=waveform_student,
+                    signal_names=testbench_signal_paths(service_request.signal_names),
+                    max_mismatches=service_request.wavejson_options.max_mismatches,
+                )
+            except VcdSignalTraversalError as e:
+                # signal_names在参考波形中找不到 是请求的问题
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error=f"signal not found in reference waveform\n{str(e)}",
+                        log=str(log),
+                    ).json(),
+                )
+            ret, msg = await run_in_threadpool(cmpr.compare)
+        is_correct = ret
+        log.write(msg)
+        judge_results_total.labels("/", "correct" if is_correct else "wrong").inc()
+
+        log.info(f"""波形已比较：{"一致" if is_correct else "不一致"}\n""")
+
+        # try:
+        # [得到波形的WaveJSON并返回]
+
+        if is_correct and service_request.wavejson_options.skip_correct:
+            wave_json_content = ""
+            log.info(f"""波形一致，跳过波形图的生成\n""")
+        else:
+            with timer.stage("wavejson"):
+                wave_json_content = await run_in_threadpool(
+                    vcd_visualize,
+                    waveform_reference=waveform_reference,
+                    waveform_student=waveform_student,
+                    signal_names=service_request.signal_names,
+                    options=service_request.wavejson_options,
+                    mismatches=cmpr.mismatches,
+                )
+            log.info(f"""波形图已生成\n""")
+        # except Exception as e:
+        #     raise HTTPException(
+        #         status_code=400,
+        #         detail=ServiceError(
+        #             error=f"波形图未成功生成\n{str(e)}",
+        #             log=str(log),
+        #         ).json(),
+        #     )
+
+        log.info(f"""判题结束\n""")
+
+        return ServiceResponse(
+            is_correct=is_correct,
+            log=str(log),
+            wavejson=wave_json_content,
+            timings=timer.timings(),
+        )
+
+
+# ------------
+
+# 批量判题时同时判题的学生数上限
+BATCH_MAX_CONCURRENT_STUDENTS = int(
+    os.environ.get("BATCH_MAX_CONCURRENT_STUDENTS", os.cpu_count() or 1)
+)
+
+
+class BatchServiceRequest(BaseModel):
+    code_reference: str = Body(title="题目答案的Verilog源文件")
+    code_students: List[str] = Body(title="多名学生提交的Verilog源文件")
+    signal_names: List[str] = Body(
+        title="需要进行波形显示的信号名称", description="指testbench中模块的信号名称"
+    )
+    testbench: str = Body(title="测试样例的Verilog文件", description="顶层模块的名称必须为`testbench`")
+    top_module: str = Body(title="顶层模块的名称，注意需要保证学生、答案的顶层模块和top_module相同")
+    wavejson_options: WaveJsonOptions = Body(
+        default=WaveJsonOptions(), title="波形图的生成选项"
+    )
+
 
-    code_student_path = base_path + "code_student.v"
-    if service_request.code_student == "":
+class BatchServiceResponseItem(BaseModel):
+    index: int = Body(title="对应的学生代码在`code_students`中的下标")
+    is_correct: bool = Body(title="判题结果 true表示此测试点通过 false表示此测试点未通过")
+    log: str = Body(title="过程日志")
+    wavejson: str = Body(title="学生模块和答案模块的波形图")
+    error: str = Body(default="", title="错误信息 为空表示判题正常完成")
+    verdict: str = Body(
+        default="",
+        title="仿真超出资源上限的原因",
+        description="`time_limit_exceeded`超时 `output_limit_exceeded`输出的波形文件过大 其他情况为空",
+    )
+    timings: Union[List[StageTiming], None] = Body(
+        default=None, title="各阶段的耗时", description="按各阶段结束的先后顺序排列"
+    )
+
+
+def judge_waveforms(
+    waveform_reference: VcdWaveform,
+    waveform_student: VcdWaveform,
+    signal_names: List[str],
+    timer: StageTimer,
+    wavejson_options: Union[WaveJsonOptions, None] = None,
+):
+    """比较学生与答案的波形并生成WaveJSON 返回(is_correct, msg, wavejson) 两步的耗时记录到timer"""
+    if wavejson_options is None:
+        wavejson_options = WaveJsonOptions()
+    with timer.stage("compare"):
+        cmpr = VcdComparator(
+            waveform_ref=waveform_reference,
+            waveform_ut=waveform_student,
+            signal_names=testbench_signal_paths(signal_names),
+            max_mismatches=wavejson_options.max_mismatches,
+        )
+        is_correct, msg = cmpr.compare()
+    if is_correct and wavejson_options.skip_correct:
+        return is_correct, msg, ""
+    with timer.stage("wavejson"):
+        wave_json_content = vcd_visualize(
+            waveform_reference=waveform_reference,
+            waveform_student=waveform_student,
+            signal_names=signal_names,
+            options=wavejson_options,
+            mismatches=cmpr.mismatches,
+        )
+    return is_correct, msg, wave_json_content
+
+
+async def judge_batch_student(
+    index: int,
+    code_student: str,
+    base_path: str,
+    testbench_path: str,
+    waveform_reference: VcdWaveform,
+    signal_names: List[str],
+    log: ProcessLog,
+    timer: StageTimer,
+    wavejson_options: Union[WaveJsonOptions, None] = None,
+) -> BatchServiceResponseItem:
+    """在base_path中仿真一名学生的代码并与答案的波形比较 log和timer为整个批次共用 不会被修改"""
+
+    log = log.copy()
+    timer = timer.copy(f"student_{index}")
+
+    def failed(error: str, verdict: str = "") -> BatchServiceResponseItem:
+        return BatchServiceResponseItem(
+            index=index,
+            is_correct=False,
+            log=str(log),
+            wavejson="",
+            error=error,
+            verdict=verdict,
+            timings=timer.timings(),
+        )
+
+    if code_student == "":
+        return failed("no verilog source provided (student)")
+
+    with timer.stage("write_sources"):
+        code_student_path = base_path + "code_student.v"
+        os.makedirs(os.path.dirname(code_student_path), exist_ok=True)
+        with open(code_student_path, "w") as f:
+            f.write(code_student)
+
+    simulation_program_student_path = base_path + "simulation_program_student"
+    vcd_student_path = base_path + "student.vcd"
+    with timer.stage("simulate"):
+        completed_iverilog_student, completed_vvp_student = await simulate(
+            code_path=code_student_path,
+            testbench_path=testbench_path,
+            simulation_program_path=simulation_program_student_path,
+            vcd_path=vcd_student_path,
+        )
+    if not check_simulation(
+        log,
+        timer,
+        "student",
+        completed_iverilog_student,
+        completed_vvp_student,
+    ):
+        return failed(
+            f"student code simulating failed\n{simulation_stderr(completed_iverilog_student, completed_vvp_student)}",
+            verdict=simulation_verdict(
+                completed_iverilog_student, completed_vvp_student
+            ),
+        )
+    log.info(f"""学生代码仿真结束\n""")
+
+    try:
+        with timer.stage("parse_vcd_student"):
+            waveform_student = await run_in_threadpool(
+                VcdWaveform, vcd_student_path, testbench_signal_paths(signal_names)
+            )
+        is_correct, msg, wave_json_content = await run_in_threadpool(
+            judge_waveforms,
+            waveform_reference,
+            waveform_student,
+            signal_names,
+            timer,
+            wavejson_options,
+        )
+    except Exception as e:
+        # 一名学生的波形出错不影响同一批次中的其他学生
+        return failed(f"波形比较失败\n{str(e)}")
+    log.write(msg)
+    log.info(f"""波形已比较：{"一致" if is_correct else "不一致"}\n""")
+    log.info(f"""判题结束\n""")
+
+    return BatchServiceResponseItem(
+        index=index,
+        is_correct=is_correct,
+        log=str(log),
+        wavejson=wave_json_content,
+        timings=timer.timings(),
+    )
+
+
+@app.post(
+    "/batch",
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}},
+            "description": "判题结果以NDJSON流式返回，每行一个`BatchServiceResponseItem`，按判题完成的先后顺序排列",
+        },
+        400: {"model": ServiceError, "description": "程序内部出错"},
+    },
+)
+async def judge_student_codes_batch(service_request: BatchServiceRequest):
+    """上传多名学生的Verilog代码与同一份答案、testbench，答案只仿真一次，逐个返回每名学生的判题结果和信号波形图"""
+
+    log = ProcessLog()
+    timer = StageTimer("/batch")
+    log.info(f"""开始处理 {datetime.now().strftime("%Y/%m/%d, %H:%M:%S")}\n""")
+
+    # [判断宿主机程序存在]
+
+    if tools.path("iverilog") is None:
         raise HTTPException(
-            status_code=400,
-            detail=ServiceError(
-                error="no verilog source provided (student)", log=log
-            ).json(),
+            status_code=404,
+            detail=ServiceError(error="iverilog not installed", log=str(log)).json(),
         )
-    os.makedirs(os.path.dirname(code_student_path), exist_ok=True)
-    with open(code_student_path, "w") as f:
-        f.write(service_request.code_student)
 
-    code_reference_path = base_path + "code_reference.v"
-    if service_request.code_reference == "":
+    log.info(f"""仿真软件已安装\n""")
+    # 结果开始流式返回后无法再返回503 各学生的仿真在此之后都只排队等待
+    admit_request("iverilog")
+
+    if len(service_request.code_students) == 0:
         raise HTTPException(
             status_code=400,
             detail=ServiceError(
-                error="no verilog source provided (reference)", log=log
+                error="no verilog source provided (student)", log=str(log)
             ).json(),
         )
-    os.makedirs(os.path.dirname(code_reference_path), exist_ok=True)
-    with open(code_reference_path, "w") as f:
-        f.write(service_request.code_reference)
 
-    testbench_path = base_path + "testbench.v"
-    if service_request.testbench == "":
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(error="no testbench provided", log=log).json(),
+    # [保存: 答案的Verilog testbench]
+    # 判题结果流式返回 工作目录在所有学生判题结束后才删除
+
+    base_path = workspaces.create()
+    try:
+        return await judge_student_codes_batch_in(
+            service_request, base_path, log, timer
         )
-    os.makedirs(os.path.dirname(testbench_path), exist_ok=True)
-    with open(testbench_path, "w") as f:
-        f.write(service_request.testbench)
+    except BaseException:
+        workspaces.release(base_path, failed=True)
+        raise
+
+
+async def judge_student_codes_batch_in(
+    service_request: BatchServiceRequest,
+    base_path: str,
+    log: ProcessLog,
+    timer: StageTimer,
+) -> StreamingResponse:
+    """在工作目录base_path中判题 返回的StreamingResponse结束时删除base_path"""
+
+    with timer.stage("write_sources"):
+        code_reference_path = base_path + "code_reference.v"
+        if service_request.code_reference == "":
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error="no verilog source provided (reference)", log=str(log)
+                ).json(),
+            )
+        os.makedirs(os.path.dirname(code_reference_path), exist_ok=True)
+        with open(code_reference_path, "w") as f:
+            f.write(service_request.code_reference)
+
+        testbench_path = base_path + "testbench.v"
+        if service_request.testbench == "":
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(error="no testbench provided", log=str(log)).json(),
+            )
+        os.makedirs(os.path.dirname(testbench_path), exist_ok=True)
+        with open(testbench_path, "w") as f:
+            f.write(service_request.testbench)
 
-    log_temp = f"""提交文件已保存\n"""
-    log += log_temp
-    print(log_temp)
+    log.info(f"""提交文件已保存\n""")
 
-    # [跑一遍参考的仿真]
-    # iverilog ./temp_uuid/testbench.v ./temp_uuid/code_reference.v -o ./temp_uuid/simulation_program_reference
-    # vvp ./temp_uuid/simulation_program_reference
-    # mv out.vcd ./temp_uuid/reference.vcd
+    # [跑一遍参考的仿真 整个批次共用]
 
     simulation_program_reference_path = base_path + "simulation_program_reference"
     vcd_reference_path = base_path + "reference.vcd"
-    completed_iverilog_reference = subprocess.run(
-        [
-            f"""iverilog {code_reference_path} {testbench_path} -D 'DUMP_FILE_NAME="{vcd_reference_path}"' -o {simulation_program_reference_path}"""
-        ],
-        capture_output=True,
-        shell=True,
+    reference_cache_key = reference_cache.key(
+        code_reference=service_request.code_reference,
+        testbench=service_request.testbench,
+        signal_names=service_request.signal_names,
     )
-    log += completed_iverilog_reference.stdout.decode("utf-8") + "\n"
-    print(log)
-    completed_vvp_reference = subprocess.run(
-        [f"vvp {simulation_program_reference_path}"],
-        capture_output=True,
-        shell=True,
+    reference_cache_hit, waveform_reference = lookup_reference(
+        reference_cache_key, vcd_reference_path
     )
-    log += completed_vvp_reference.stdout.decode("utf-8") + "\n"
-    if (
-        completed_iverilog_reference.returncode != 0
-        or completed_vvp_reference.returncode != 0
-    ):
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(
-                error=f"reference code simulating failed\n{completed_iverilog_reference.stderr.decode('utf-8')}\n{completed_vvp_reference.stderr.decode('utf-8')}",
-                log=log,
-            ).json(),
+    if reference_cache_hit:
+        log.info(f"""参考代码仿真缓存命中 {reference_cache_key[:16]}\n""")
+    else:
+        log.info(f"""参考代码仿真缓存未命中 {reference_cache_key[:16]}\n""")
+
+        with timer.stage("simulate"):
+            completed_iverilog_reference, completed_vvp_reference = await simulate(
+                code_path=code_reference_path,
+                testbench_path=testbench_path,
+                simulation_program_path=simulation_program_reference_path,
+                vcd_path=vcd_reference_path,
+            )
+        if not check_simulation(
+            log,
+            timer,
+            "reference",
+            completed_iverilog_reference,
+            completed_vvp_reference,
+        ):
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error=f"reference code simulating failed\n{simulation_stderr(completed_iverilog_reference, completed_vvp_reference)}",
+                    log=str(log),
+                ).json(),
+            )
+
+        await run_in_threadpool(
+            reference_cache.store, reference_cache_key, vcd_reference_path
+        )
+
+    with timer.stage("parse_vcd_reference"):
+        waveform_reference = await load_reference_waveform(
+            reference_cache_key,
+            vcd_reference_path,
+            service_request.signal_names,
+            waveform_reference,
         )
 
-    log_temp = f"""参考代码仿真结束\n"""
-    log += log_temp
-    print(log_temp)
+    log.info(f"""参考代码仿真结束\n""")
 
-    # [跑一遍学生的仿真]
+    # [并行判题 按完成顺序流式返回]
 
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENT_STUDENTS)
+
+    async def judge_one(index: int, code_student: str) -> BatchServiceResponseItem:
+        async with semaphore:
+            return await judge_batch_student(
+                index=index,
+                code_student=code_student,
+                base_path=base_path + f"student_{index}/",
+                testbench_path=testbench_path,
+                waveform_reference=waveform_reference,
+                signal_names=service_request.signal_names,
+                log=log,
+                timer=timer,
+                wavejson_options=service_request.wavejson_options,
+            )
+
+    async def stream_results():
+        tasks = [
+            asyncio.ensure_future(judge_one(index, code_student))
+            for index, code_student in enumerate(service_request.code_students)
+        ]
+        failed = False
+        try:
+            for next_finished in asyncio.as_completed(tasks):
+                item = await next_finished
+                logger.info(f"""学生{item.index}判题结束：{item.is_correct}""")
+                if item.error != "":
+                    verdict = item.verdict or "error"
+                else:
+                    verdict = "correct" if item.is_correct else "wrong"
+                judge_results_total.labels("/batch", verdict).inc()
+                failed = failed or item.error != ""
+                yield item.json() + "\n"
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            # 客户端提前断开时取消尚未完成的判题
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            workspaces.release(base_path, failed=failed)
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+# ------------
+
+
+class MultiTestcaseServiceRequest(BaseModel):
+    code_reference: str = Body(title="题目答案的Verilog源文件")
+    code_student: str = Body(title="学生提交的Verilog源文件")
+    signal_names: List[str] = Body(
+        title="需要进行波形显示的信号名称", description="指testbench中模块的信号名称"
+    )
+    testbenches: List[str] = Body(
+        title="按顺序排列的多个测试样例的Verilog文件", description="顶层模块的名称必须为`testbench`"
+    )
+    top_module: str = Body(title="顶层模块的名称，注意需要保证学生、答案的顶层模块和top_module相同")
+    parallel: bool = Body(
+        default=False,
+        title="是否并行运行各测试点",
+        description="为false时按顺序运行，遇到第一个未通过的测试点即停止；为true时同时运行，任一测试点未通过即取消其余测试点",
+    )
+    wavejson_options: WaveJsonOptions = Body(
+        default=WaveJsonOptions(), title="波形图的生成选项"
+    )
+
+
+class TestcaseResult(BaseModel):
+    index: int = Body(title="测试点在`testbenches`中的下标")
+    verdict: str = Body(
+        title="测试点结果",
+        description="`correct`通过 `wrong`波形不一致 `time_limit_exceeded`学生代码仿真超时 `output_limit_exceeded`学生代码输出的波形文件过大 `error`学生代码仿真失败 `skipped`因其他测试点未通过而未运行或被取消",
+    )
+    log: str = Body(title="过程日志")
+    wavejson: str = Body(title="学生模块和答案模块的波形图")
+    error: str = Body(default="", title="错误信息")
+    time_seconds: float = Body(title="测试点耗时（秒）")
+    timings: Union[List[StageTiming], None] = Body(
+        default=None, title="各阶段的耗时", description="按各阶段结束的先后顺序排列"
+    )
+
+
+class MultiTestcaseServiceResponse(BaseModel):
+    is_correct: bool = Body(title="判题结果 true表示所有测试点都通过")
+    log: str = Body(title="过程日志")
+    testcases: List[TestcaseResult] = Body(title="各测试点的结果 与`testbenches`一一对应")
+    timings: Union[List[StageTiming], None] = Body(
+        default=None, title="各阶段的耗时", description="按各阶段结束的先后顺序排列"
+    )
+
+
+async def judge_testcase(
+    index: int,
+    testbench: str,
+    code_reference: str,
+    code_reference_path: str,
+    code_student_path: str,
+    signal_names: List[str],
+    base_path: str,
+    timer: StageTimer,
+    wavejson_options: Union[WaveJsonOptions, None] = None,
+) -> TestcaseResult:
+    """在base_path中用一个testbench分别仿真答案和学生代码并比较波形 各阶段的耗时记录到timer"""
+
+    time_start = time.monotonic()
+    log = ProcessLog()
+    log.info(f"""测试点{index}开始\n""")
+
+    def finished(verdict: str, wavejson: str = "", error: str = "") -> TestcaseResult:
+        return TestcaseResult(
+            index=index,
+            verdict=verdict,
+            log=str(log),
+            wavejson=wavejson,
+            error=error,
+            time_seconds=time.monotonic() - time_start,
+            timings=timer.timings(),
+        )
+
+    with timer.stage("write_sources"):
+        testbench_path = base_path + "testbench.v"
+        if testbench == "":
+            return finished("error", error="no testbench provided")
+        os.makedirs(os.path.dirname(testbench_path), exist_ok=True)
+        with open(testbench_path, "w") as f:
+            f.write(testbench)
+
+    simulation_program_reference_path = base_path + "simulation_program_reference"
+    vcd_reference_path = base_path + "reference.vcd"
     simulation_program_student_path = base_path + "simulation_program_student"
     vcd_student_path = base_path + "student.vcd"
-    completed_iverilog_student = subprocess.run(
-        [
-            f"""iverilog {code_student_path} {testbench_path}  -D 'DUMP_FILE_NAME="{vcd_student_path}"' -o {simulation_program_student_path}"""
-        ],
-        capture_output=True,
-        shell=True,
+
+    reference_cache_key = reference_cache.key(
+        code_reference=code_reference,
+        testbench=testbench,
+        signal_names=signal_names,
     )
-    log += completed_iverilog_student.stdout.decode("utf-8") + "\n"
-    completed_vvp_student = subprocess.run(
-        [f"vvp {simulation_program_student_path}"],
-        capture_output=True,
-        shell=True,
+    reference_cache_hit, waveform_reference = lookup_reference(
+        reference_cache_key, vcd_reference_path
     )
-    log += completed_vvp_student.stdout.decode("utf-8") + "\n"
-    if (
-        completed_iverilog_student.returncode != 0
-        or completed_vvp_student.returncode != 0
+    if reference_cache_hit:
+        log.info(f"""参考代码仿真缓存命中 {reference_cache_key[:16]}\n""")
+    else:
+        log.info(f"""参考代码仿真缓存未命中 {reference_cache_key[:16]}\n""")
+
+    with timer.stage("simulate"):
+        simulate_student = simulate(
+            code_path=code_student_path,
+            testbench_path=testbench_path,
+            simulation_program_path=simulation_program_student_path,
+            vcd_path=vcd_student_path,
+        )
+        if reference_cache_hit:
+            completed_iverilog_student, completed_vvp_student = await simulate_student
+        else:
+            (
+                (completed_iverilog_reference, completed_vvp_reference),
+                (completed_iverilog_student, completed_vvp_student),
+            ) = await gather_or_cancel(
+                simulate(
+                    code_path=code_reference_path,
+                    testbench_path=testbench_path,
+                    simulation_program_path=simulation_program_reference_path,
+                    vcd_path=vcd_reference_path,
+                ),
+                simulate_student,
+            )
+
+    if not reference_cache_hit:
+        if not check_simulation(
+            log,
+            timer,
+            "reference",
+            completed_iverilog_reference,
+            completed_vvp_reference,
+        ):
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error=f"reference code simulating failed (testcase {index})\n{simulation_stderr(completed_iverilog_reference, completed_vvp_reference)}",
+                    log=str(log),
+                ).json(),
+            )
+
+        await run_in_threadpool(
+            reference_cache.store, reference_cache_key, vcd_reference_path
+        )
+
+    if not check_simulation(
+        log,
+        timer,
+        "student",
+        completed_iverilog_student,
+        completed_vvp_student,
     ):
+        return finished(
+            simulation_verdict(completed_iverilog_student, completed_vvp_student)
+            or "error",
+            error=f"student code simulating failed\n{simulation_stderr(completed_iverilog_student, completed_vvp_student)}",
+        )
+    log.info(f"""仿真结束\n""")
+
+    with timer.stage("parse_vcd_reference"):
+        waveform_reference = await load_reference_waveform(
+            reference_cache_key, vcd_reference_path, signal_names, waveform_reference
+        )
+    with timer.stage("parse_vcd_student"):
+        waveform_student = await run_in_threadpool(
+            VcdWaveform, vcd_student_path, testbench_signal_paths(signal_names)
+        )
+    try:
+        is_correct, msg, wave_json_content = await run_in_threadpool(
+            judge_waveforms,
+            waveform_reference,
+            waveform_student,
+            signal_names,
+            timer,
+            wavejson_options,
+        )
+    except VcdSignalTraversalError as e:
         raise HTTPException(
             status_code=400,
             detail=ServiceError(
-                error=f"student code simulating failed\n{completed_iverilog_student.stderr.decode('utf-8')}\n{completed_vvp_student.stderr.decode('utf-8')}",
-                log=log,
+                error=f"signal not found in reference waveform (testcase {index})\n{str(e)}",
+                log=str(log),
             ).json(),
         )
+    log.write(msg)
+    log.info(f"""波形已比较：{"一致" if is_correct else "不一致"}\n""")
 
-    log_temp = f"""学生代码仿真结束\n"""
-    log += log_temp
-    print(log_temp)
+    return finished("correct" if is_correct else "wrong", wavejson=wave_json_content)
 
-    # [判断波形图是否一致]
 
-    print(log)
-    cmpr = VcdComparator(
-        vcd_ref=vcd_reference_path,
-        vcd_ut=vcd_student_path,
-        signal_names=list(
-            map(lambda name: f"root/testbench/{name}", service_request.signal_names)
-        ),
-    )
-    ret, msg = cmpr.compare()
-    print(msg, "Ret status: {}".format(ret))
-    is_correct = ret
-    log += msg
+@app.post(
+    "/testcases",
+    responses={
+        200: {"model": MultiTestcaseServiceResponse, "description": "判题结束"},
+        400: {"model": ServiceError, "description": "程序内部出错"},
+    },
+)
+async def judge_student_code_testcases(service_request: MultiTestcaseServiceRequest):
+    """上传学生的Verilog代码、答案和多个testbench，依次判题，遇到第一个未通过的测试点即停止"""
 
-    log_temp = f"""波形已比较：{"一致" if is_correct else "不一致"}\n"""
-    log += log_temp
-    print(log_temp)
+    log = ProcessLog()
+    timer = StageTimer("/testcases")
+    log.info(f"""开始处理 {datetime.now().strftime("%Y/%m/%d, %H:%M:%S")}\n""")
 
-    # try:
-    # [得到波形的WaveJSON并返回]
+    # [判断宿主机程序存在]
 
-    wave_json_content = vcd_visualize(
-        vcd_reference_path=vcd_reference_path,
-        vcd_student_path=vcd_student_path,
-        signal_names=service_request.signal_names,
-    )
+    if tools.path("iverilog") is None:
+        raise HTTPException(
+            status_code=404,
+            detail=ServiceError(error="iverilog not installed", log=str(log)).json(),
+        )
+
+    log.info(f"""仿真软件已安装\n""")
+    admit_request("iverilog")
 
-    log_temp = f"""波形图已生成\n"""
-    log += log_temp
-    print(log_temp)
-    # except Exception as e:
-    #     raise HTTPException(
-    #         status_code=400,
-    #         detail=ServiceError(
-    #             error=f"波形图未成功生成\n{str(e)}",
-    #             log=log,
-    #         ).json(),
-    #     )
-
-    log_temp = f"""判题结束\n"""
-    log += log_temp
-    print(log_temp)
-
-    return ServiceResponse(is_correct=is_correct, log=log, wavejson=wave_json_content)
+    # [保存: 学生提交的Verilog 答案的Verilog]
+
+    with workspaces.workspace() as base_path:
+        if len(service_request.testbenches) == 0:
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(error="no testbench provided", log=str(log)).json(),
+            )
+
+        with timer.stage("write_sources"):
+            code_student_path = base_path + "code_student.v"
+            if service_request.code_student == "":
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error="no verilog source provided (student)", log=str(log)
+                    ).json(),
+                )
+            os.makedirs(os.path.dirname(code_student_path), exist_ok=True)
+            with open(code_student_path, "w") as f:
+                f.write(service_request.code_student)
+
+            code_reference_path = base_path + "code_reference.v"
+            if service_request.code_reference == "":
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error="no verilog source provided (reference)", log=str(log)
+                    ).json(),
+                )
+            os.makedirs(os.path.dirname(code_reference_path), exist_ok=True)
+            with open(code_reference_path, "w") as f:
+                f.write(service_request.code_reference)
+
+        log.info(f"""提交文件已保存\n""")
+
+        # [逐个运行测试点 遇到第一个未通过的测试点即停止]
+
+        def run_testcase(index: int):
+            return judge_testcase(
+                index=index,
+                testbench=service_request.testbenches[index],
+                code_reference=service_request.code_reference,
+                code_reference_path=code_reference_path,
+                code_student_path=code_student_path,
+                signal_names=service_request.signal_names,
+                base_path=base_path + f"testcase_{index}/",
+                timer=timer.fork(f"testcase_{index}"),
+                wavejson_options=service_request.wavejson_options,
+            )
+
+        results = {}
+        if service_request.parallel:
+            tasks = [
+                asyncio.ensure_future(run_testcase(index))
+                for index in range(len(service_request.testbenches))
+            ]
+            try:
+                for next_finished in asyncio.as_completed(tasks):
+                    result = await next_finished
+                    results[result.index] = result
+                    if result.verdict != "correct":
+                        break
+            finally:
+                # 已有测试点未通过 取消其余测试点（同时结束其仿真进程）
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        else:
+            for index in range(len(service_request.testbenches)):
+                result = await run_testcase(index)
+                results[index] = result
+                if result.verdict != "correct":
+                    break
+
+        testcases = []
+        for index in range(len(service_request.testbenches)):
+            if index in results:
+                testcases.append(results[index])
+            else:
+                testcases.append(
+                    TestcaseResult(
+                        index=index,
+                        verdict="skipped",
+                        log="",
+                        wavejson="",
+                        time_seconds=0,
+                    )
+                )
+            log.info(
+                f"""测试点{index}：{testcases[index].verdict} {testcases[index].time_seconds:.3f}s\n"""
+            )
+            judge_results_total.labels("/testcases", testcases[index].verdict).inc()
+
+        is_correct = all(testcase.verdict == "correct" for testcase in testcases)
+
+        log.info(f"""判题结束\n""")
+
+        return MultiTestcaseServiceResponse(
+            is_correct=is_correct,
+            log=str(log),
+            testcases=testcases,
+            timings=timer.timings(),
+        )
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Throughput of :func:`VcdParser.parse_tokens` (original token parser) and
+:func:`VcdParser.parse` (block parser) and :func:`VcdParser.parse_mmap`
+on generated VCD dumps
+
+python3 benchmarks/vcdParser_benchmark.py 10 100 1000   # sizes of dumps in MB
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from pyDigitalWaveTools.vcd.parser import VcdParser
+
+
+def generate_vcd(path: str, size: int, signal_cnt: int=64, seed: int=0):
+    """
+    Write a dump similar to the ones produced by Icarus Verilog for `$dumpvars;`
+    of a whole design, with scalar and vector signals, until it has at least `size` bytes
+    """
+    rand = random.Random(seed)
+    ids = []
+    widths = []
+    with open(path, "w") as f:
+        f.write("$date\n\tgenerated\n$end\n$version\n\tvcdParser_benchmark\n$end\n"
+                "$timescale\n\t1ns\n$end\n$scope module testbench $end\n")
+        for i in range(signal_cnt):
+            vcdId = ""
+            n = i
+            while True:
+                vcdId += chr(33 + n % 94)
+                n //= 94
+                if n == 0:
+                    break
+            width = 1 if i % 2 else rand.choice([2, 8, 16, 32])
+            ids.append(vcdId)
+            widths.append(width)
+            f.write(f"$var wire {width:d} {vcdId:s} sig{i:d} [{width - 1:d}:0] $end\n")
+        f.write("$upscope $end\n$enddefinitions $end\n#0\n$dumpvars\n")
+        for vcdId, width in zip(ids, widths):
+            f.write(f"x{vcdId}\n" if width == 1 else f"bx {vcdId}\n")
+        f.write("$end\n")
+
+        t = 0
+        while f.tell() < size:
+            t += rand.randint(1, 10)
+            lines = [f"#{t:d}"]
+            for _ in range(rand.randint(1, signal_cnt // 4)):
+                i = rand.randrange(signal_cnt)
+                if widths[i] == 1:
+                    lines.append(f"{rand.choice('01'):s}{ids[i]:s}")
+                else:
+                    lines.append(f"b{rand.getrandbits(widths[i]):b} {ids[i]:s}")
+            lines.append("")
+            f.write("\n".join(lines))
+
+
+def measure(parse, path: str, mode: str):
+    vcd = VcdParser()
+    with open(path, mode) as f:
+        t0 = time.perf_counter()
+        parse(vcd, f)
+        t1 = time.perf_counter()
+    return t1 - t0
+
+
+def measure_mmap(path: str):
+    vcd = VcdParser()
+    t0 = time.perf_counter()
+    vcd.parse_mmap(path)
+    t1 = time.perf_counter()
+    return t1 - t0
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argp.add_argument("sizes", nargs="*", type=int, default=[10],
+                      help="sizes of the generated dumps in MB")
+    argp.add_argument("--skip-tokens", action="store_true",
+                      help="do not run the (slow) original token parser")
+    args = argp.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        for size_mb in args.sizes:
+            path = os.path.join(d, f"dump_{size_mb:d}MB.vcd")
+            generate_vcd(path, size_mb * 1024 * 1024)
+            mb = os.path.getsize(path) / (1024 * 1024)
+            results = []
+            if not args.skip_tokens:
+                results.append(("parse_tokens", measure(VcdParser.parse_tokens, path, "r")))
+            results.append(("parse", measure(VcdParser.parse, path, "rb")))
+            results.append(("parse_mmap", measure_mmap(path)))
+            for name, t in results:
+                print(f"{mb:8.1f} MB  {name:12s} {t:8.2f} s  {mb / t:8.2f} MB/s")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,18 +13,56 @@ Needs some hooks for callbacks on signal changes and methods to allow sampling o
 Refer to IEEE SystemVerilog standard 1800-2009 for VCD details Section 21.7 Value Change Dump (VCD) files
 '''
 
-from collections import defaultdict
+from array import array
+from collections import defaultdict, deque
+from fnmatch import fnmatchcase
 from io import StringIO
 from itertools import dropwhile
+import mmap
+import re
 
 from pyDigitalWaveTools.vcd.common import VcdVarScope, VcdVarInfo
-from typing import Union
+from pyDigitalWaveTools.vcd.value_format import vcdValueToBitVector
+from typing import Callable, Collection, Dict, List, Union
+
+# value changes of signals which were filtered out are appended here and discarded
+_DISCARDED_SERIES = deque(maxlen=0)
 
 
 class VcdSyntaxError(Exception):
     pass
 
 
+GLOB_CHARS = frozenset("*?[")
+
+
+def is_glob(pattern: str) -> bool:
+    return not GLOB_CHARS.isdisjoint(pattern)
+
+
+def path_matches(pattern: str, path: str) -> bool:
+    '''
+    Match "/" joined path with a glob pattern, wildcards do not match across "/"
+    ("root/tb/dut/*" matches "root/tb/dut/x" but not "root/tb/dut/sub/x")
+    '''
+    pattern_parts = pattern.split("/")
+    path_parts = path.split("/")
+    return len(pattern_parts) == len(path_parts) and all(
+        fnmatchcase(name, p) for name, p in zip(path_parts, pattern_parts))
+
+
+def path_matcher(patterns: Collection[str]) -> Callable[[str], bool]:
+    '''
+    :return: predicate which tells if a path is one of the paths
+        or matches any of the glob patterns (see :func:`~.path_matches`)
+    '''
+    paths = frozenset(p for p in patterns if not is_glob(p))
+    globs = [p for p in patterns if is_glob(p)]
+    if not globs:
+        return paths.__contains__
+    return lambda path: path in paths or any(path_matches(g, path) for g in globs)
+
+
 class VcdDuplicatedVariableError(Exception):
     """
     This is when multiple definition to one variable happens.
@@ -39,21 +77,91 @@ class VcdDuplicatedVariableError(Exception):
     pass
 
 
+class VcdColumnarSeries(object):
+    """
+    Value changes of a variable stored in columns instead of a list of (time, value) tuples.
+    Behaves as a read only sequence of (time, value) tuples, new changes are added by :func:`~.append`.
+
+    :ivar ~.times: array('q') of times of the value changes
+    :ivar ~.codes: array('I') of indexes of the values in :attr:`~.values`
+    :ivar ~.values: list of distinct values (str) in order of the first occurrence
+    :ivar ~.canonical: :attr:`~.values` converted by :func:`~.vcdValueToBitVector`,
+        values which differ only in formatting have the same canonical value
+    """
+    __slots__ = ("times", "codes", "values", "canonical", "_value2code")
+
+    def __init__(self):
+        self.times = array('q')
+        self.codes = array('I')
+        self.values = []
+        self.canonical = []
+        self._value2code = {}
+
+    def append(self, change):
+        time, value = change
+        code = self._value2code.get(value)
+        if code is None:
+            # every distinct value is converted just once
+            code = self._value2code[value] = len(self.values)
+            self.values.append(value)
+            self.canonical.append(vcdValueToBitVector(value))
+        self.times.append(time)
+        self.codes.append(code)
+
+    def canonical_changes(self):
+        '''
+        :return: iterator of (time, canonical value) tuples
+        '''
+        return zip(self.times, map(self.canonical.__getitem__, self.codes))
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            values = self.values
+            return [(t, values[c]) for t, c in zip(self.times[index], self.codes[index])]
+        return (self.times[index], self.values[self.codes[index]])
+
+    def __iter__(self):
+        return zip(self.times, map(self.values.__getitem__, self.codes))
+
+    def __eq__(self, other):
+        if isinstance(other, (VcdColumnarSeries, list)):
+            return self.toJson() == list(other)
+        return NotImplemented
+
+    def toJson(self):
+        return list(self)
+
+
 class VcdVarParsingInfo(VcdVarInfo):
     """
     Container of informations about variable in VCD for parsing of VCD file
+
+    :param columnar: store the value changes in :class:`~.VcdColumnarSeries` instead of a list
     """
 
-    def __init__(self, vcdId: Union[str, VcdVarInfo], name: str, width, sigType, parent):
+    def __init__(self, vcdId: Union[str, VcdVarInfo], name: str, width, sigType, parent,
+                 columnar: bool=False):
         super(VcdVarParsingInfo, self).__init__(
             vcdId, name, width, sigType, parent)
-        self.data = []
+        if isinstance(vcdId, VcdVarParsingInfo):
+            # alias of a variable with the same id code, shares its data
+            self.data = vcdId.data
+        elif columnar:
+            self.data = VcdColumnarSeries()
+        else:
+            self.data = []
 
     def toJson(self):
+        data = self.data
+        if isinstance(data, VcdColumnarSeries):
+            data = data.toJson()
         return {"name": self.name,
                 "type": {"width": self.width,
                          "name": self.sigType},
-                "data": self.data}
+                "data": data}
 
 
 class VcdParser(object):
@@ -66,7 +174,20 @@ class VcdParser(object):
     :ivar ~.scope: actual VcdSignalInfo
     :ivar ~.now: actual time (int)
     :ivar ~.idcode2series: dictionary {idcode: series} where series are list of tuples (time, value)
+        or :class:`~.VcdColumnarSeries`
+    :ivar ~.idcode2var: dictionary {idcode: first VcdVarParsingInfo declared with this idcode}
+    :ivar ~.path_index: dictionary {signal path: VcdVarParsingInfo}, built at $enddefinitions,
+        see :func:`~.find` and :func:`~.select`
     :ivar ~.signals: dict {topName: VcdSignalInfo instance}
+
+    :param signal_filter: if specified only value changes of the selected signals are stored,
+        other signals keep empty data. Either a collection of signal paths or a predicate
+        called with a signal path. Signal path is "/" joined names of the scopes
+        and the variable, starting with the root scope ("root/testbench/x").
+        The paths in the collection may be glob patterns (see :func:`~.path_matches`).
+    :param columnar: store value changes in :class:`~.VcdColumnarSeries` (array of times
+        and indexes of distinct values) instead of lists of tuples, which takes a fraction
+        of the memory, :func:`~.VcdVarParsingInfo.toJson` still returns lists
     '''
     VECTOR_VALUE_CHANGE_PREFIX = {
         "b", "B", "r", "R"
@@ -74,8 +195,13 @@ class VcdParser(object):
     SCOPE_TYPES = {
         "begin", "fork", "function", "module", "task"
     }
+    # keywords around value changes, the changes in them are parsed as any other
+    VALUE_CHANGE_KEYWORDS = {
+        b"$dumpall", b"$dumpoff", b"$dumpon", b"$dumpvars", b"$end"
+    }
 
-    def __init__(self):
+    def __init__(self, signal_filter: Union[Collection[str], Callable[[str], bool], None]=None,
+                 columnar: bool=False):
         keyword_functions = {
             # declaration_keyword ::=
             "$comment": self.drop_while_end,
@@ -110,8 +236,17 @@ class VcdParser(object):
         self.scope = VcdVarScope("root", None)
         self.setNow(0)
         self.idcode2series = {}
+        self.idcode2var = {}
         self.end_of_definitions = False
 
+        if signal_filter is None or callable(signal_filter):
+            self.signal_filter = signal_filter
+        else:
+            self.signal_filter = path_matcher(signal_filter)
+        self.selected_idcodes = set()
+        self.path_index = {}
+        self.columnar = columnar
+
     def value_change(self, vcdId, value, lineNo):
         '''append change from VCD file signal data series'''
         try:    
@@ -132,7 +267,40 @@ class VcdParser(object):
 
     def parse(self, file_handle):
         '''
-        Tokenize and parse the VCD file
+        Parse the VCD file
+
+        The declarations are parsed token by token, the value changes are
+        read in large blocks of bytes and parsed by :func:`~._parse_words`.
+        The result is the same as of :func:`~.parse_tokens`.
+
+        :ivar ~.file_handle: opened file with vcd string (text or binary mode)
+        '''
+        self.parse_chunks(self._read_chunks(file_handle))
+
+    def parse_mmap(self, path):
+        '''
+        Parse the VCD file by memory mapping it
+
+        The file is scanned as bytes one block at a time, so the file is never loaded
+        into Python objects at once, only the kept values are decoded to str.
+        The result is the same as of :func:`~.parse`.
+
+        :ivar ~.path: path of the vcd file
+        '''
+        with open(path, "rb") as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file can not be mapped
+                raise VcdSyntaxError("missing end of declaration section")
+        with mm:
+            self.parse_chunks(self._mmap_chunks(mm))
+
+    def parse_tokens(self, file_handle):
+        '''
+        Tokenize and parse the VCD file one (lineNo, word) token at a time
+
+        Original implementation of :func:`~.parse`, slower but reports line numbers.
 
         :ivar ~.file_handle: opened file with vcd string
         '''
@@ -147,12 +315,7 @@ class VcdParser(object):
         #        yield t
         # tokeniser = tokeniser_wrap()
 
-        while True:
-            token = next(tokeniser)
-            # parse VCD until the end of definitions
-            self.keyword_dispatch[token[1]](tokeniser, token[1])
-            if self.end_of_definitions:
-                break
+        self._parse_definitions(tokeniser)
 
         while True:
             try:
@@ -170,6 +333,143 @@ class VcdParser(object):
             else:
                 self.vcd_value_change(lineNo, token, tokeniser)
 
+    def _parse_definitions(self, tokeniser):
+        while True:
+            token = next(tokeniser)
+            # parse VCD until the end of definitions
+            self.keyword_dispatch[token[1]](tokeniser, token[1])
+            if self.end_of_definitions:
+                break
+
+    CHUNK_SIZE = 1 << 20
+    ENDDEFINITIONS_RE = re.compile(rb"\$enddefinitions\s+\$end(?=\s|$)")
+
+    @classmethod
+    def _read_chunks(cls, file_handle):
+        while True:
+            chunk = file_handle.read(cls.CHUNK_SIZE)
+            if not chunk:
+                return
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield chunk
+
+    @classmethod
+    def _mmap_chunks(cls, mm):
+        size = len(mm)
+        for start in range(0, size, cls.CHUNK_SIZE):
+            yield mm[start:start + cls.CHUNK_SIZE]
+
+    def parse_chunks(self, chunks):
+        '''
+        Parse the VCD file from an iterable of bytes objects (arbitrary split)
+        '''
+        chunks = iter(chunks)
+        # declarations are short, collect them and use the token parser
+        head = bytearray()
+        m = None
+        for chunk in chunks:
+            head += chunk
+            m = self.ENDDEFINITIONS_RE.search(head)
+            if m is not None:
+                break
+        if m is None:
+            raise VcdSyntaxError("missing end of declaration section")
+
+        definitions = head[:m.end()].decode()
+        tokeniser = ((lineNo, word)
+                     for lineNo, line in enumerate(definitions.splitlines())
+                     for word in line.split() if word)
+        self._parse_definitions(tokeniser)
+
+        idcode2series = {vcdId.encode(): series
+                         for vcdId, series in self.idcode2series.items()}
+        rest = bytes(head[m.end():])
+        del head
+
+        # split blocks on the last line end so that no word is cut in half,
+        # words of an unfinished value change are moved to the next block
+        for chunk in chunks:
+            rest += chunk
+            cut = rest.rfind(b"\n")
+            if cut < 0:
+                continue
+            words = rest[:cut].split()
+            i = self._parse_words(words, idcode2series)
+            if i == len(words):
+                rest = rest[cut:]
+            else:
+                rest = b" ".join(words[i:]) + rest[cut:]
+
+        words = rest.split()
+        i = self._parse_words(words, idcode2series)
+        if i != len(words):
+            raise VcdSyntaxError("Unexpected end of file after: ",
+                                 b" ".join(words[i:]).decode())
+
+    def _parse_words(self, words, idcode2series):
+        '''
+        Parse value changes from the list of words (bytes)
+
+        :return: index of the first word which was not parsed because its value change
+            is not complete in this list
+        '''
+        get_series = idcode2series.get
+        discarded = _DISCARDED_SERIES
+        now = self.now
+        n = len(words)
+        i = 0
+        while i < n:
+            w = words[i]
+            c = w[0]
+            if c == 35:  # "#"
+                now = int(w[1:])
+                i += 1
+                continue
+            elif c == 98 or c == 66 or c == 114 or c == 82:  # "b", "B", "r", "R"
+                # vectors and reals
+                if i + 1 == n:
+                    break
+                vcdId = words[i + 1]
+                series = get_series(vcdId)
+                if series is not discarded and series is not None:
+                    series.append((now, w.decode()))
+                i += 2
+            elif c == 36:  # "$"
+                if w == b"$comment":
+                    try:
+                        i = words.index(b"$end", i + 1) + 1
+                    except ValueError:
+                        break
+                    continue
+                elif w in self.VALUE_CHANGE_KEYWORDS:
+                    i += 1
+                    continue
+                else:
+                    self.parse_error(None, w.decode())
+            elif c == 115:  # "s"
+                # string value
+                if i + 1 == n:
+                    break
+                vcdId = words[i + 1]
+                series = get_series(vcdId)
+                if series is not discarded and series is not None:
+                    series.append((now, w[1:].decode()))
+                i += 2
+            else:
+                # 1 bit value
+                vcdId = w[1:]
+                series = get_series(vcdId)
+                if series is not discarded and series is not None:
+                    series.append((now, chr(c)))
+                i += 1
+
+            if series is None:
+                print("Wrong vcdId:", vcdId.decode())
+
+        self.now = now
+        return i
+
     def vcd_value_change(self, lineNo, token, tokenizer):
         token = token.strip()
         if not token:
@@ -212,6 +512,11 @@ class VcdParser(object):
 
     def vcd_enddefinitions(self, tokeniser, keyword):
         self.end_of_definitions = True
+        self.path_index = self.build_path_index(self.scope)
+        if self.signal_filter is not None:
+            for vcdId in self.idcode2series.keys():
+                if vcdId not in self.selected_idcodes:
+                    self.idcode2series[vcdId] = _DISCARDED_SERIES
         self.drop_while_end(tokeniser, keyword)
 
     def vcd_scope(self, tokeniser, keyword):
@@ -240,13 +545,64 @@ class VcdParser(object):
         (var_type, size, vcdId, reference) = data[:4]
         parent = self.scope
         size = int(size)
-        parent_var = self.idcode2series.get(vcdId, None)
+        parent_var = self.idcode2var.get(vcdId, None)
         info = VcdVarParsingInfo(vcdId if parent_var is None else parent_var,
-                                 reference, size, var_type, parent)
+                                 reference, size, var_type, parent, self.columnar)
         assert reference not in parent.children
         parent.children[reference] = info
         if parent_var is None:
+            self.idcode2var[vcdId] = info
             self.idcode2series[vcdId] = info.data
+        if self.signal_filter is not None and self.signal_filter(self.var_path(info)):
+            self.selected_idcodes.add(vcdId)
+
+    @staticmethod
+    def build_path_index(scope: VcdVarScope) -> Dict[str, VcdVarInfo]:
+        '''
+        :return: dictionary {"/" joined path: variable} for all variables in the scope
+            in the order of declaration
+        '''
+        index = {}
+
+        def add_scope(path, s):
+            for name, ch in s.children.items():
+                ch_path = path + "/" + name
+                if isinstance(ch, VcdVarScope):
+                    add_scope(ch_path, ch)
+                else:
+                    index[ch_path] = ch
+
+        add_scope(scope.name, scope)
+        return index
+
+    def find(self, path: str) -> Union[VcdVarInfo, None]:
+        '''
+        :return: variable with the "/" joined path ("root/testbench/x") or None
+        '''
+        return self.path_index.get(path)
+
+    def select(self, pattern: str) -> List[VcdVarInfo]:
+        '''
+        :return: all variables whose path matches the glob pattern ("root/testbench/dut/*"),
+            see :func:`~.path_matches`
+        '''
+        if not is_glob(pattern):
+            var = self.path_index.get(pattern)
+            return [] if var is None else [var]
+        return [var for path, var in self.path_index.items()
+                if path_matches(pattern, path)]
+
+    @staticmethod
+    def var_path(var: VcdVarInfo) -> str:
+        """
+        :return: "/" joined names from the root scope to the variable
+        """
+        names = []
+        o = var
+        while o is not None:
+            names.append(o.name)
+            o = o.parent
+        return "/".join(reversed(names))
 
     def _vcd_value_change_list(self, tokeniser):
         while True:
@@ -1,5 +1,12 @@
 from io import StringIO
-from typing import Optional
+from typing import Optional, Tuple, Union
+
+# 4 state bit: (val, xz_mask), x and z have the mask bit set and differ in the val bit
+VCD_BIT_VALUES = {
+    "0": (0, 0), "1": (1, 0),
+    "x": (0, 1), "X": (0, 1),
+    "z": (1, 1), "Z": (1, 1),
+}
 
 
 def bitVectorToStr(val: int, width: int, vld_mask: int, prefix: Optional[str], suffix: Optional[str]):
@@ -29,6 +36,57 @@ def bitToStr(val: int, vld_mask: int):
     else:
         return "X"
 
+def vcdValueToBitVector(value: str) -> Union[Tuple[int, int], float, str]:
+    """
+    Convert value from VCD file to a canonical form which does not depend on formatting
+    ("0", "b0" and "b000" are the same value, as well as "bx" and "bxxx")
+
+    :return: tuple (val, xz_mask) for bits and bit vectors. Bits set in xz_mask are x
+        (the bit in val is 0) or z (the bit in val is 1). As in VCD the value is extended
+        to the left by 0, or by x/z if it is the most significant bit, the extension
+        is infinite so val and xz_mask may be negative and do not depend on the width.
+        Float for reals, the original string for anything else.
+    """
+    if not value:
+        return value
+    c = value[0]
+    if c == "b" or c == "B":
+        bits = value[1:]
+    elif c == "r" or c == "R":
+        try:
+            return float(value[1:])
+        except ValueError:
+            return value
+    elif len(value) == 1 and c in VCD_BIT_VALUES:
+        bits = value
+    else:
+        return value
+
+    if not bits:
+        return value
+    # int() would also accept "_", "+" and "-"
+    if not bits.strip("01"):
+        return (int(bits, 2), 0)
+
+    val = 0
+    xz_mask = 0
+    for b in bits:
+        try:
+            v, m = VCD_BIT_VALUES[b]
+        except KeyError:
+            return value
+        val = (val << 1) | v
+        xz_mask = (xz_mask << 1) | m
+
+    msb_val, msb_xz = VCD_BIT_VALUES[bits[0]]
+    if msb_xz:
+        ext = -1 << len(bits)
+        xz_mask |= ext
+        if msb_val:
+            val |= ext
+    return (val, xz_mask)
+
+
 class LogValueFormatter():
     def bind_var_info(self, varInfo: "VcdVarWritingInfo"):
         pass
@@ -3,7 +3,9 @@
 
 import unittest
 import os
-from pyDigitalWaveTools.vcd.parser import VcdParser
+from pyDigitalWaveTools.vcd.common import VcdVarScope
+from pyDigitalWaveTools.vcd.parser import VcdParser, VcdColumnarSeries
+from pyDigitalWaveTools.vcd.value_format import vcdValueToBitVector
 
 BASE = os.path.dirname(os.path.realpath(__file__))
 
@@ -65,6 +67,186 @@ class VcdParserTC(unittest.TestCase):
         vcd = self.parse_file("multiscope.vcd")
         vcd.scope.toJson()
 
+    ALIASED_VCD = """$timescale 1s $end
+$scope module testbench $end
+$var reg 3 ! x [2:0] $end
+$var wire 8 " y [7:0] $end
+$scope module DUT $end
+$var wire 3 ! x [2:0] $end
+$var reg 8 " y [7:0] $end
+$upscope $end
+$upscope $end
+$enddefinitions $end
+#0
+$dumpvars
+bx !
+bx "
+$end
+#1
+b0 !
+b1 "
+#2
+b1 !
+b10 "
+"""
+
+    def test_alias(self):
+        vcd = VcdParser()
+        vcd.parse_str(self.ALIASED_VCD)
+        tb = vcd.scope.children["testbench"]
+        dut = tb.children["DUT"]
+        self.assertEqual(dut.children["x"].data, [(0, "bx"), (1, "b0"), (2, "b1")])
+        self.assertEqual(dut.children["x"].data, tb.children["x"].data)
+        self.assertEqual(dut.children["y"].data, tb.children["y"].data)
+
+    def test_signal_filter(self):
+        vcd = VcdParser(signal_filter={"root/testbench/x"})
+        vcd.parse_str(self.ALIASED_VCD)
+        tb = vcd.scope.children["testbench"]
+        self.assertEqual(tb.children["x"].data, [(0, "bx"), (1, "b0"), (2, "b1")])
+        self.assertEqual(tb.children["y"].data, [])
+        self.assertEqual(tb.children["DUT"].children["y"].data, [])
+
+    def test_path_index(self):
+        vcd = VcdParser()
+        vcd.parse_str(self.ALIASED_VCD)
+        tb = vcd.scope.children["testbench"]
+        self.assertEqual(list(vcd.path_index.keys()), [
+            "root/testbench/x", "root/testbench/y",
+            "root/testbench/DUT/x", "root/testbench/DUT/y"])
+        self.assertIs(vcd.find("root/testbench/DUT/y"), tb.children["DUT"].children["y"])
+        self.assertIsNone(vcd.find("root/testbench/z"))
+        self.assertEqual(vcd.select("root/testbench/x"), [tb.children["x"]])
+        self.assertEqual(vcd.select("root/testbench/*"), [tb.children["x"], tb.children["y"]])
+        self.assertEqual(vcd.select("root/testbench/DUT/?"),
+                         list(tb.children["DUT"].children.values()))
+
+        vcd = VcdParser(signal_filter=["root/testbench/DUT/*"])
+        vcd.parse_str(self.ALIASED_VCD)
+        tb = vcd.scope.children["testbench"]
+        self.assertEqual(tb.children["DUT"].children["x"].data,
+                         [(0, "bx"), (1, "b0"), (2, "b1")])
+        self.assertEqual(tb.children["y"].data, [(0, "bx"), (1, "b1"), (2, "b10")])
+
+    def test_signal_filter_alias(self):
+        # only the alias is selected, the first declaration shares its data
+        vcd = VcdParser(signal_filter=lambda path: path.endswith("DUT/y"))
+        vcd.parse_str(self.ALIASED_VCD)
+        tb = vcd.scope.children["testbench"]
+        self.assertEqual(tb.children["DUT"].children["y"].data,
+                         [(0, "bx"), (1, "b1"), (2, "b10")])
+        self.assertEqual(tb.children["x"].data, [])
+
+    def test_signal_filter_same_result(self):
+        vcd = self.parse_file("AxiRegTC_test_write.vcd")
+        paths = []
+
+        def collect(o):
+            if isinstance(o, VcdVarScope):
+                for ch in o.children.values():
+                    collect(ch)
+            else:
+                paths.append(o)
+
+        collect(vcd.scope)
+        selected = paths[::3]
+        fIn = os.path.join(BASE, "AxiRegTC_test_write.vcd")
+        with open(fIn) as vcd_file:
+            vcd_filtered = VcdParser(signal_filter=[VcdParser.var_path(v) for v in selected])
+            vcd_filtered.parse(vcd_file)
+        for v in selected:
+            path = VcdParser.var_path(v).split("/")[1:]
+            o = vcd_filtered.scope
+            for name in path:
+                o = o.children[name]
+            self.assertEqual(o.data, v.data)
+
+    def test_parse_same_as_parse_tokens(self):
+        for rel_name in ["example0.vcd", "AxiRegTC_test_write.vcd",
+                         "verilog2005-sample0.vcd", "verilog2005-sample1.vcd",
+                         "multiscope.vcd"]:
+            fIn = os.path.join(BASE, rel_name)
+            with open(fIn) as vcd_file:
+                ref = VcdParser()
+                ref.parse_tokens(vcd_file)
+            with open(fIn, "rb") as vcd_file:
+                vcd = VcdParser()
+                vcd.parse(vcd_file)
+            self.assertEqual(ref.scope.toJson(), vcd.scope.toJson(), rel_name)
+
+            # blocks split in the middle of words and value changes
+            with open(fIn, "rb") as vcd_file:
+                buff = vcd_file.read()
+            for chunk_size in [1, 7, 64]:
+                vcd = VcdParser()
+                vcd.parse_chunks(buff[i:i + chunk_size]
+                                 for i in range(0, len(buff), chunk_size))
+                self.assertEqual(ref.scope.toJson(), vcd.scope.toJson(),
+                                 (rel_name, chunk_size))
+
+    def test_parse_mmap(self):
+        for rel_name in ["example0.vcd", "AxiRegTC_test_write.vcd",
+                         "verilog2005-sample0.vcd", "verilog2005-sample1.vcd",
+                         "multiscope.vcd"]:
+            fIn = os.path.join(BASE, rel_name)
+            with open(fIn) as vcd_file:
+                ref = VcdParser()
+                ref.parse_tokens(vcd_file)
+            vcd = VcdParser()
+            vcd.parse_mmap(fIn)
+            self.assertEqual(ref.scope.toJson(), vcd.scope.toJson(), rel_name)
+
+    def test_columnar(self):
+        for rel_name in ["example0.vcd", "AxiRegTC_test_write.vcd",
+                         "verilog2005-sample0.vcd", "verilog2005-sample1.vcd",
+                         "multiscope.vcd"]:
+            fIn = os.path.join(BASE, rel_name)
+            ref = VcdParser()
+            ref.parse_mmap(fIn)
+            vcd = VcdParser(columnar=True)
+            vcd.parse_mmap(fIn)
+            self.assertEqual(ref.scope.toJson(), vcd.scope.toJson(), rel_name)
+
+        vcd = VcdParser(columnar=True)
+        vcd.parse_str(self.ALIASED_VCD)
+        tb = vcd.scope.children["testbench"]
+        x = tb.children["x"]
+        y = tb.children["DUT"].children["x"]
+        self.assertIsInstance(x.data, VcdColumnarSeries)
+        self.assertIs(x.data, y.data)
+        self.assertEqual(len(x.data), len(x.data.toJson()))
+        self.assertEqual(x.data[-1], x.data.toJson()[-1])
+        self.assertEqual(x.data[1:], x.data.toJson()[1:])
+        self.assertEqual(len(x.data.values), len(set(v for _, v in x.data)))
+
+    def test_canonical_values(self):
+        same = [
+            ["0", "b0", "b000", "B0"],
+            ["1", "b1", "b001"],
+            ["x", "bx", "bxxx", "X"],
+            ["z", "bz", "bzzz"],
+            ["b0x", "b00x"],
+            ["b1x", "b01x"],
+        ]
+        canonical = []
+        for values in same:
+            c = {vcdValueToBitVector(v) for v in values}
+            self.assertEqual(len(c), 1, values)
+            canonical.extend(c)
+        self.assertEqual(len(set(canonical)), len(same))
+        self.assertEqual(vcdValueToBitVector("b1x0z"), (0b1001, 0b0101))
+        self.assertEqual(vcdValueToBitVector("r1.5"), 1.5)
+        self.assertEqual(vcdValueToBitVector("hello"), "hello")
+        self.assertEqual(vcdValueToBitVector(""), "")
+        for v in ["b1_0", "b+1", "b-1", "1_"]:
+            self.assertEqual(vcdValueToBitVector(v), v)
+
+        vcd = VcdParser(columnar=True)
+        vcd.parse_str(self.ALIASED_VCD)
+        x = vcd.scope.children["testbench"].children["x"]
+        self.assertEqual(list(x.data.canonical_changes()),
+                         [(t, vcdValueToBitVector(v)) for t, v in x.data])
+
 
 if __name__ == "__main__":
     suite = unittest.TestSuite()
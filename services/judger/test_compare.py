@@ -0,0 +1,130 @@
+from toolchain import StageTimer
+
+from .main import (
+    signal_mismatches,
+    judge_waveforms,
+    VcdComparator,
+    VcdMismatch,
+    VcdWaveform,
+    WaveJsonOptions,
+)
+
+
+def test_same_waveform():
+    data = [(0, "b0"), (5, "b1"), (10, "b10")]
+    assert signal_mismatches("out", data, list(data), 10) == []
+
+
+def test_repeated_changes_are_ignored():
+    data_ref = [(0, "0"), (5, "1")]
+    data_ud = [(0, "0"), (3, "1"), (3, "0"), (5, "1"), (5, "1")]
+    assert signal_mismatches("out", data_ref, data_ud, 10) == []
+
+
+def test_student_has_fewer_changes():
+    data_ref = [(0, "0"), (5, "1"), (9, "0")]
+    data_ud = [(0, "0"), (5, "1")]
+    assert signal_mismatches("out", data_ref, data_ud, 10) == [
+        VcdMismatch("out", 9, None, "0", "1")
+    ]
+
+
+def test_student_has_extra_changes():
+    data_ref = [(0, "0"), (5, "1")]
+    data_ud = [(0, "0"), (5, "1"), (7, "0"), (8, "1"), (10, "0")]
+    assert signal_mismatches("out", data_ref, data_ud, 10) == [
+        VcdMismatch("out", 7, 8, "1", "0"),
+        VcdMismatch("out", 10, None, "1", "0"),
+    ]
+
+
+def test_first_mismatches():
+    data_ref = [(i, str(i % 2)) for i in range(100)]
+    data_ud = [(i, "0") for i in range(100)]
+    mismatches = signal_mismatches("out", data_ref, data_ud, 3)
+    assert [(m.start, m.end) for m in mismatches] == [(1, 2), (3, 4), (5, 6)]
+
+
+class Waveform:
+    def __init__(self, signals):
+        self.signals = signals
+
+    def signal(self, signal_path):
+        data = self.signals[signal_path]
+        return {"name": signal_path, "type": {"width": 3}, "data": data}
+
+    def expand(self, signal_paths):
+        return signal_paths
+
+    def has(self, signal_path):
+        return signal_path in self.signals
+
+
+def test_value_formatting_is_ignored():
+    waveform_ref = Waveform({"out": [(0, "bx"), (5, "b0"), (10, "b101")]})
+    waveform_ut = Waveform({"out": [(0, "bxxx"), (5, "b000"), (10, "b101")]})
+    assert VcdComparator(waveform_ref, waveform_ut, ["out"]).compare() == (
+        True,
+        "无误\n",
+    )
+
+    waveform_ut = Waveform({"out": [(0, "bxxx"), (5, "b0z0"), (10, "b101")]})
+    cmpr = VcdComparator(waveform_ref, waveform_ut, ["out"])
+    assert cmpr.compare()[0] == False
+    assert cmpr.mismatches == [VcdMismatch("out", 5, 10, "b000", "b0z0")]
+
+
+def test_max_mismatches_option():
+    waveform_ref = Waveform(
+        {"root/testbench/out": [(i, "b" + str(i % 2)) for i in range(100)]}
+    )
+    waveform_ut = Waveform({"root/testbench/out": [(i, "b0") for i in range(100)]})
+    is_correct, msg, _ = judge_waveforms(
+        waveform_ref,
+        waveform_ut,
+        ["out"],
+        StageTimer("/"),
+        WaveJsonOptions(max_mismatches=3, mismatch_window=1),
+    )
+    assert not is_correct
+    assert "（只列出前3处不一致）" in msg
+
+
+def write_vcd(path, internal_wires):
+    """testbench中例化了dut dut中有out和internal_wires这些内部信号"""
+    wires = [("out", "!")] + [
+        (name, chr(ord('"') + i)) for i, name in enumerate(internal_wires)
+    ]
+    lines = [
+        "$timescale 1ns $end",
+        "$scope module testbench $end",
+        "$scope module dut $end",
+    ]
+    lines += [f"$var wire 1 {code} {name} $end" for name, code in wires]
+    lines += ["$upscope $end", "$upscope $end", "$enddefinitions $end", "#0"]
+    lines += [f"0{code}" for _, code in wires]
+    lines += ["#5"] + [f"1{code}" for _, code in wires]
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+def test_internal_signals_differ(tmp_path):
+    signal_paths = ["root/testbench/dut/*"]
+    waveform_ref = VcdWaveform(write_vcd(tmp_path / "ref.vcd", ["tmp"]), signal_paths)
+    waveform_ut = VcdWaveform(write_vcd(tmp_path / "ut.vcd", ["t0"]), signal_paths)
+
+    is_correct, msg, wavejson = judge_waveforms(
+        waveform_ref, waveform_ut, ["dut/*"], StageTimer("/")
+    )
+    assert not is_correct
+    assert "Signal root/testbench/dut/tmp does not exist in ud" in msg
+    # 学生波形中没有的信号只显示参考的波形
+    assert "reference_tmp" in wavejson
+    assert "your_tmp" not in wavejson
+    assert "your_out" in wavejson
+
+    waveform_ut = VcdWaveform(
+        write_vcd(tmp_path / "ut2.vcd", ["tmp", "t0"]), signal_paths
+    )
+    cmpr = VcdComparator(waveform_ref, waveform_ut, signal_paths)
+    assert cmpr.compare() == (True, "无误\n")
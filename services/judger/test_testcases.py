@@ -0,0 +1,127 @@
+import json
+import time
+
+from fastapi.testclient import TestClient
+
+from .main import app
+
+client = TestClient(app)
+
+top_module = "population_count"
+signal_names = ["in", "out"]
+code_reference = """
+module population_count(
+    input [2:0] in,
+    output [1:0] out
+);
+    assign out = in[2] + in[1] + in[0];
+endmodule
+    """
+
+testbench = """
+module testbench();
+    reg [2:0] in;
+    wire [1:0] out;
+    population_count PopCount(in, out);
+    
+    initial begin
+        $dumpfile(`DUMP_FILE_NAME);
+        $dumpvars;
+    end
+
+    integer i;
+    initial begin
+        for (i = 0; i < 8; i = i + 1) begin
+            #1 in = i;
+        end
+    end
+endmodule
+    """
+
+
+def judge_testcases(code_student, testbenches, parallel=False):
+    request_data = {
+        "top_module": top_module,
+        "signal_names": signal_names,
+        "code_reference": code_reference,
+        "code_student": code_student,
+        "testbenches": testbenches,
+        "parallel": parallel,
+    }
+
+    response_origin = client.post("/testcases", json=request_data)
+    print(f"[status_code] {response_origin.status_code}")
+
+    if response_origin.status_code == 200:
+        print(f"[SUCCEDDED]")
+        response = json.loads(response_origin.content)
+
+        print(f'[is_correct] {response["is_correct"]}')
+        print(f'[log] {response["log"]}')
+        for testcase in response["testcases"]:
+            print(f'[verdict] {testcase["verdict"]} {testcase["time_seconds"]}s')
+            print(f'[wavejson] {testcase["wavejson"]}')
+    elif response_origin.status_code == 400:
+        print(f"[FAILED]")
+        response = json.loads(json.loads(response_origin.content)["detail"])
+
+        print(f'[error] {response["error"]}')
+        print(f'[log] {response["log"]}')
+    else:
+        print(f"[FAILED]")
+
+        print("[error]" + str(response_origin.content))
+
+    assert response_origin.status_code == 200
+    return response
+
+
+def test_main():
+    response = judge_testcases(
+        code_reference,
+        [testbench, testbench.replace("#1 in = i;", "#2 in = 7 - i;")],
+    )
+
+    assert response["is_correct"]
+    assert [testcase["verdict"] for testcase in response["testcases"]] == [
+        "correct",
+        "correct",
+    ]
+
+
+def test_early_exit():
+    # 只数了两位 in为3'b100时出错
+    code_student = code_reference.replace("in[2] + in[1] + in[0]", "in[1] + in[0]")
+
+    response = judge_testcases(code_student, [testbench, testbench, testbench])
+
+    assert not response["is_correct"]
+    assert [testcase["verdict"] for testcase in response["testcases"]] == [
+        "wrong",
+        "skipped",
+        "skipped",
+    ]
+    assert response["testcases"][0]["wavejson"] != ""
+
+
+def test_parallel_cancels_remaining_testcases():
+    code_student = code_reference.replace("in[2] + in[1] + in[0]", "in[1] + in[0]")
+    # 答案和学生的仿真都会一直运行到超出资源上限
+    # 放在后面 排队等待运行的工具按测试点的顺序开始 第一个测试点不会排在它们后面
+    testbench_endless = testbench.replace("i < 8", "i >= 0")
+
+    time_start = time.monotonic()
+    response = judge_testcases(
+        code_student,
+        [testbench, testbench_endless, testbench_endless],
+        parallel=True,
+    )
+
+    assert not response["is_correct"]
+    assert [testcase["verdict"] for testcase in response["testcases"]] == [
+        "wrong",
+        "skipped",
+        "skipped",
+    ]
+    # 未完成的测试点被取消 不必等到vvp超时（默认CPU时间上限10秒）
+    assert time.monotonic() - time_start < 5
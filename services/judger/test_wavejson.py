@@ -0,0 +1,65 @@
+from .main import VcdConverter, WaveTimeAxis
+
+
+class Waveform:
+    def __init__(self, signals):
+        self.signals = signals
+
+    def signal(self, signal_path):
+        return self.signals[signal_path]
+
+
+def test_wavejson():
+    waveform = Waveform(
+        {
+            "out": {
+                "name": "out",
+                "type": {"width": 2},
+                "data": [(0, "bx"), (2, "b01"), (4, "b11")],
+            }
+        }
+    )
+    vc = VcdConverter(waveform)
+    vc.addToWaveJsonSeparate(["out"], "your_")
+    vc.addToWaveJsonAggregated(["out"], "your_")
+    assert vc.emitWaveDict() == {
+        "signal": [
+            {"name": "your_out[0]", "wave": "x.1..."},
+            {"name": "your_out[1]", "wave": "x.0.1."},
+            {"name": "your_out", "wave": "=.=.=.", "data": ["x", 1, 3]},
+        ]
+    }
+
+
+def test_wavejson_long_simulation():
+    data = [(t, "b" + format(t % 256, "b")) for t in range(0, 1000000, 1000)]
+    waveform = Waveform({"out": {"name": "out", "type": {"width": 8}, "data": data}})
+    vc = VcdConverter(waveform)
+    vc.addToWaveJsonAggregated(["out"])
+    (sig_json,) = vc.emitWaveDict()["signal"]
+    assert len(sig_json["wave"]) == data[-1][0] + 2
+    assert sig_json["wave"].count("=") == len(data)
+
+
+def test_wavejson_compact():
+    data = [(t, "01"[(t // 10) % 2]) for t in range(0, 100, 10)]
+    data += [(1000, "0"), (1010, "1")]
+    waveform = Waveform({"clk": {"name": "clk", "type": {"width": 1}, "data": data}})
+    time_axis = WaveTimeAxis([time for time, _ in data], compact=True, max_idle=20)
+    assert time_axis.period == 10
+    vc = VcdConverter(waveform, time_axis)
+    vc.addToWaveJsonSeparate(["clk"])
+    assert vc.emitWaveDict() == {
+        "signal": [{"name": "clk[0]", "wave": "0101010101|01."}]
+    }
+
+
+def test_wavejson_mismatch_window():
+    data = [(t, "01"[(t // 10) % 2]) for t in range(0, 1000, 10)]
+    time_axis = WaveTimeAxis(
+        [time for time, _ in data], compact=True, windows=[(497, 503)]
+    )
+    waveform = Waveform({"clk": {"name": "clk", "type": {"width": 1}, "data": data}})
+    vc = VcdConverter(waveform, time_axis)
+    vc.addToWaveJsonSeparate(["clk"])
+    assert vc.emitWaveDict() == {"signal": [{"name": "clk[0]", "wave": "|101|."}]}
@@ -6,3 +6,15 @@ app = FastAPI()
 @app.get("/")
 def read_root():
     return {"service_id": 0}
+
+
+@app.get("/healthz")
+def healthz():
+    """存活检查 服务进程能响应即返回200"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    """就绪检查 此服务不依赖外部工具 能响应即就绪"""
+    return {"ready": True}
@@ -1,12 +1,22 @@
-from typing import Union, List
-import subprocess
+from typing import List, Union
 import os
-import uuid
 from datetime import datetime
 
 from fastapi import FastAPI, Body, HTTPException
 from pydantic import BaseModel
 
+from toolchain import (
+    ProcessLog,
+    StageTimer,
+    StageTiming,
+    admit_request,
+    install_service_routes,
+    logger,
+    run_tool,
+    tools,
+    workspaces,
+)
+
 
 app = FastAPI()
 
@@ -19,6 +29,9 @@ class ServiceRequest(BaseModel):
 class ServiceResponse(BaseModel):
     netlist_svg: str = Body(title="用netlistsvg生成的逻辑电路图")
     log: str = Body(title="过程日志")
+    timings: Union[List[StageTiming], None] = Body(
+        default=None, title="各阶段的耗时", description="按各阶段结束的先后顺序排列"
+    )
 
 
 class ServiceError(BaseModel):
@@ -26,6 +39,9 @@ class ServiceError(BaseModel):
     log: str = Body(title="过程日志")
 
 
+install_service_routes(app, ["yosys", "netlistsvg"], ServiceError)
+
+
 @app.post(
     "/",
     # https://fastapi.tiangolo.com/advanced/additional-responses/
@@ -34,102 +50,98 @@ class ServiceError(BaseModel):
         400: {"model": ServiceError, "description": "程序内部出错"},
     },
 )
-def convert_verilog_sources_to_netlist_svg(service_request: ServiceRequest):
+async def convert_verilog_sources_to_netlist_svg(service_request: ServiceRequest):
     """上传Verilog源文件并指定顶层模块，返回逻辑电路图svg"""
 
-    print(f"start with request {service_request}")
-    log = "开始处理" + datetime.now().strftime("%Y/%m/%d, %H:%M:%S")
+    logger.debug(f"start with request {service_request}")
+    log = ProcessLog()
+    timer = StageTimer("/")
+    log.info("开始处理" + datetime.now().strftime("%Y/%m/%d, %H:%M:%S"))
 
     # [判断宿主机程序存在]
 
-    def program_exists(program_name: str) -> Union[str, None]:
-        """Check whether `name` is on PATH and marked as executable."""
-        from shutil import which
-
-        return which(program_name) is not None
-
-    if not program_exists("yosys"):
+    if tools.path("yosys") is None:
         raise HTTPException(
             status_code=404,
-            detail=ServiceError(error="yosys not installed", log=log).json(),
+            detail=ServiceError(error="yosys not installed", log=str(log)).json(),
         )
-    if not program_exists("netlistsvg"):
+    if tools.path("netlistsvg") is None:
         raise HTTPException(
             status_code=404,
-            detail=ServiceError(error="netlistsvg not installed", log=log).json(),
+            detail=ServiceError(error="netlistsvg not installed", log=str(log)).json(),
         )
+    admit_request("yosys")
 
     # [保存用户上传的verilog源文件]
 
-    processing_id = uuid.uuid4().hex
-    base_path = (
-        f"./temp/{processing_id}/"  # https://docs.python.org/3/library/uuid.html
-    )
-    verilog_sources_folder = "verilog_sources/"
-    if service_request.verilog_sources.count == 0:
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(error="no verilog sources provided", log=log).json(),
-        )
-    verilog_sources_path = []
-    for i, verilog_source in enumerate(service_request.verilog_sources):
-        verilog_source_path = base_path + verilog_sources_folder + str(i) + ".v"
-        verilog_sources_path.append(verilog_source_path)
-        os.makedirs(os.path.dirname(verilog_source_path), exist_ok=True)
-        with open(verilog_source_path, "w") as f:
-            f.write(verilog_source)
-
-    # [生成yosys脚本]
-
-    netlist_json_path = base_path + "netlist.json"
-    yosys_script_content = f"""
+    with workspaces.workspace() as base_path:
+        with timer.stage("write_sources"):
+            verilog_sources_folder = "verilog_sources/"
+            if service_request.verilog_sources.count == 0:
+                raise HTTPException(
+                    status_code=400,
+                    detail=ServiceError(
+                        error="no verilog sources provided", log=str(log)
+                    ).json(),
+                )
+            verilog_sources_path = []
+            for i, verilog_source in enumerate(service_request.verilog_sources):
+                verilog_source_path = base_path + verilog_sources_folder + str(i) + ".v"
+                verilog_sources_path.append(verilog_source_path)
+                os.makedirs(os.path.dirname(verilog_source_path), exist_ok=True)
+                with open(verilog_source_path, "w") as f:
+                    f.write(verilog_source)
+
+        # [生成yosys脚本]
+
+        netlist_json_path = base_path + "netlist.json"
+        yosys_script_content = f"""
 read -sv {" ".join(verilog_sources_path)} 
 hierarchy -top {service_request.top_module}
 proc; opt; techmap; opt
 write_json {netlist_json_path}
     """.strip()
-    yosys_script_path = base_path + "verilog2netlistsvg.ys"
-    os.makedirs(os.path.dirname(yosys_script_path), exist_ok=True)
-    with open(yosys_script_path, "w") as f:
-        f.write(yosys_script_content)
-
-    # [运行yosys脚本]
-
-    completed_yosys = subprocess.run(
-        [f"yosys {yosys_script_path}"],  # 注意这里块不能分开写 否则yosys会进入交互模式
-        capture_output=True,
-        shell=True,
-    )  # https://docs.python.org/3/library/subprocess.html#subprocess.run
-    log += completed_yosys.stdout.decode("utf-8")
-    if completed_yosys.returncode != 0:
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(
-                error=f"run yosys failed\n{completed_yosys.stderr.decode('utf-8')}",
-                log=log,
-            ).json(),
+        yosys_script_path = base_path + "verilog2netlistsvg.ys"
+        os.makedirs(os.path.dirname(yosys_script_path), exist_ok=True)
+        with open(yosys_script_path, "w") as f:
+            f.write(yosys_script_content)
+
+        # [运行yosys脚本]
+
+        completed_yosys = await run_tool(["yosys", yosys_script_path])
+        log.tool(completed_yosys)
+        timer.tool("yosys", completed_yosys)
+        if completed_yosys.returncode != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error=f"run yosys failed\n{completed_yosys.stderr.decode('utf-8')}",
+                    log=str(log),
+                ).json(),
+            )
+
+        # [运行netlistsvg]
+
+        netlist_svg_path = base_path + "netlist.svg"
+        completed_netlistsvg = await run_tool(
+            # https://github.com/nturley/netlistsvg#generating-input_json_file-with-yosys
+            ["netlistsvg", netlist_json_path, "-o", netlist_svg_path],
         )
-
-    # [运行netlistsvg]
-
-    netlist_svg_path = base_path + "netlist.svg"
-    completed_netlistsvg = subprocess.run(
-        # https://github.com/nturley/netlistsvg#generating-input_json_file-with-yosys
-        ["netlistsvg", netlist_json_path, "-o", netlist_svg_path],
-        capture_output=True,
-    )
-    log += completed_netlistsvg.stdout.decode("utf-8")
-    if completed_netlistsvg.returncode != 0:
-        raise HTTPException(
-            status_code=400,
-            detail=ServiceError(
-                error=f"run netlistsvg failed {completed_netlistsvg.stderr.decode('utf-8')}",
-                log=log,
-            ).json(),
+        log.tool(completed_netlistsvg)
+        timer.tool("netlistsvg", completed_netlistsvg)
+        if completed_netlistsvg.returncode != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=ServiceError(
+                    error=f"run netlistsvg failed {completed_netlistsvg.stderr.decode('utf-8')}",
+                    log=str(log),
+                ).json(),
+            )
+
+        # [读取netlist.svg并返回]
+
+        with open(netlist_svg_path, "r") as f:
+            netlist_svg_content = f.read()
+        return ServiceResponse(
+            log=str(log), netlist_svg=netlist_svg_content, timings=timer.timings()
         )
-
-    # [读取netlist.svg并返回]
-
-    with open(netlist_svg_path, "r") as f:
-        netlist_svg_content = f.read()
-    return ServiceResponse(log=log, netlist_svg=netlist_svg_content)